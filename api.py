@@ -0,0 +1,328 @@
+import gzip
+import hashlib
+import json
+from functools import wraps
+
+from flask import Blueprint, current_app, request, abort
+from flask_login import current_user, login_user, logout_user
+from werkzeug.exceptions import HTTPException
+from models import db, User, Product, Category, CartItem, Order, OrderItem
+from catalog import catalog_page
+from facets import category_facets
+from cache import catalog_cache
+from pagination import paginate, InvalidCursor
+from passwords import password_hasher, HashingBusy
+from identity import user_cache
+import counters
+import sessions
+import inventory
+import orders
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Versioned JSON API for mobile and partner clients. Responses are compact
+# JSON with a strong ETag (If-None-Match gets a 304) and are compressed with
+# brotli (when the brotli package is installed) or gzip when the client
+# accepts it. Authentication uses the same session cookie as the site; log
+# in with POST /api/v1/session.
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+COMPRESS_MIN_BYTES = 512
+MAX_PAGE = 100
+MAX_BATCH = 100
+
+
+def api_response(data, status=200, public=False):
+    body = json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode()
+    etag = hashlib.sha1(body).hexdigest()
+
+    encodings = ['br', 'gzip'] if brotli is not None else ['gzip']
+    encoding = request.accept_encodings.best_match(encodings) if len(body) >= COMPRESS_MIN_BYTES else None
+    if encoding:
+        # Each encoding of the same document is a different representation
+        etag = f'{etag}-{encoding}'
+
+    response = current_app.response_class(status=status, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept-Encoding' if public else 'Accept-Encoding, Cookie'
+    response.headers['Cache-Control'] = 'public, max-age=30' if public else 'private, no-cache'
+    if status == 200 and request.method in ('GET', 'HEAD') and etag in request.if_none_match:
+        response.status_code = 304
+        return response
+
+    if encoding == 'br':
+        body = brotli.compress(body)
+    elif encoding == 'gzip':
+        body = gzip.compress(body, compresslevel=6)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.set_data(body)
+    return response
+
+
+def api_login_required(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not current_user.is_authenticated:
+            return api_response({'error': 'authentication required'}, 401)
+        return view(*args, **kwargs)
+    return wrapper
+
+
+@api.errorhandler(HTTPException)
+def handle_http_error(e):
+    return api_response({'error': e.description}, e.code)
+
+
+@api.errorhandler(HashingBusy)
+def handle_hashing_busy(e):
+    response = api_response({'error': 'server busy, retry shortly'}, 503)
+    response.headers['Retry-After'] = '1'
+    return response
+
+
+def product_json(product, detail=False):
+    data = {
+        'id': product.id,
+        'title': product.title,
+        'author': product.author,
+        'price': product.price,
+        'stock': product.stock,
+        'category_id': product.category_id,
+        'image_url': product.image_url,
+    }
+    if detail:
+        data['description'] = product.description
+    return data
+
+
+def order_json(order):
+    return {
+        'id': order.id,
+        'total': order.total,
+        'status': order.status,
+        'created_at': order.created_at.isoformat(),
+        'items': [{
+            'product_id': item.product_id,
+            'title': item.product.title if item.product else None,
+            'quantity': item.quantity,
+            'price': item.price,
+        } for item in order.items],
+    }
+
+
+def page_size():
+    return min(max(request.args.get('limit', current_app.config['PRODUCTS_PER_PAGE'], type=int), 1), MAX_PAGE)
+
+
+# Session
+
+@api.route('/session', methods=['POST'])
+def create_session():
+    data = request.get_json(silent=True) or {}
+    username = str(data.get('username', ''))
+    retry_after = password_hasher.retry_after(username, request.remote_addr)
+    if retry_after:
+        response = api_response({'error': 'too many failed login attempts'}, 429)
+        response.headers['Retry-After'] = str(retry_after)
+        return response
+    user = User.query.filter_by(username=username).first()
+    if not password_hasher.authenticate(user, str(data.get('password', ''))):
+        password_hasher.login_failed(username, request.remote_addr)
+        return api_response({'error': 'invalid username or password'}, 401)
+    db.session.commit()
+    password_hasher.login_succeeded(username)
+    sessions.regenerate()
+    user_cache.put(user)
+    login_user(user)
+    return api_response({'id': user.id, 'username': user.username})
+
+
+@api.route('/session', methods=['DELETE'])
+def delete_session():
+    logout_user()
+    return api_response({}, 200)
+
+
+# Catalog
+
+@api.route('/categories')
+def categories():
+    rows = Category.query.order_by(Category.id).all()
+    return api_response({'categories': [{'id': c.id, 'name': c.name} for c in rows]}, public=True)
+
+
+@api.route('/facets')
+def facets():
+    return api_response({'categories': [f._asdict() for f in category_facets(request.args.get('search', ''))]},
+                        public=True)
+
+
+@api.route('/products')
+def products():
+    try:
+        page = catalog_page(request.args, page_size())
+    except InvalidCursor:
+        abort(400, 'invalid cursor')
+    return api_response({
+        'products': [product_json(p) for p in page.items],
+        'next_cursor': page.next_cursor,
+    }, public=True)
+
+
+@api.route('/products/<int:id>')
+def product(id):
+    return api_response(product_json(db.get_or_404(Product, id), detail=True), public=True)
+
+
+# Hydrate many products in one request: /products/batch?ids=3,1,2
+@api.route('/products/batch')
+def products_batch():
+    try:
+        ids = [int(i) for i in request.args.get('ids', '').split(',') if i.strip()]
+    except ValueError:
+        abort(400, 'ids must be a comma-separated list of integers')
+    if len(ids) > MAX_BATCH:
+        abort(400, f'at most {MAX_BATCH} ids per request')
+    found = {p.id: p for p in Product.query.filter(Product.id.in_(ids))}
+    return api_response({
+        'products': [product_json(found[i]) for i in dict.fromkeys(ids) if i in found],
+        'missing': [i for i in dict.fromkeys(ids) if i not in found],
+    }, public=True)
+
+
+# Cart
+
+def not_available(e):
+    return api_response({'error': 'not enough stock', 'product_id': e.product_id, 'available': e.available}, 409)
+
+
+def cart_json(user_id):
+    items = orders.load_cart(user_id)
+    return {
+        'items': [{
+            'id': item.id,
+            'quantity': item.quantity,
+            'product': product_json(item.product),
+        } for item in items],
+        'total': round(sum(item.product.price * item.quantity for item in items), 2),
+    }
+
+
+@api.route('/cart')
+@api_login_required
+def cart():
+    return api_response(cart_json(current_user.id))
+
+
+@api.route('/cart', methods=['POST'])
+@api_login_required
+def add_to_cart():
+    data = request.get_json(silent=True) or {}
+    try:
+        product_id = int(data['product_id'])
+        quantity = int(data.get('quantity', 1))
+    except (KeyError, TypeError, ValueError):
+        abort(400, 'product_id and an integer quantity are required')
+    if quantity < 1:
+        abort(400, 'quantity must be positive')
+    db.get_or_404(Product, product_id)
+
+    item = CartItem.query.filter_by(user_id=current_user.id, product_id=product_id).first()
+    try:
+        inventory.reserve(current_user.id, product_id, quantity + (item.quantity if item else 0))
+    except inventory.NotAvailable as e:
+        return not_available(e)
+    if item:
+        item.quantity += quantity
+    else:
+        db.session.add(CartItem(user_id=current_user.id, product_id=product_id, quantity=quantity))
+    db.session.commit()
+    counters.invalidate()
+    return api_response(cart_json(current_user.id), 201)
+
+
+def own_cart_item(item_id):
+    return CartItem.query.filter_by(id=item_id, user_id=current_user.id).first_or_404()
+
+
+@api.route('/cart/<int:item_id>', methods=['PUT'])
+@api_login_required
+def update_cart_item(item_id):
+    item = own_cart_item(item_id)
+    data = request.get_json(silent=True) or {}
+    try:
+        quantity = int(data['quantity'])
+    except (KeyError, TypeError, ValueError):
+        abort(400, 'an integer quantity is required')
+    if quantity > 0:
+        try:
+            inventory.reserve(current_user.id, item.product_id, quantity)
+        except inventory.NotAvailable as e:
+            return not_available(e)
+        item.quantity = quantity
+    else:
+        inventory.release(current_user.id, [item.product_id])
+        db.session.delete(item)
+    db.session.commit()
+    counters.invalidate()
+    return api_response(cart_json(current_user.id))
+
+
+@api.route('/cart/<int:item_id>', methods=['DELETE'])
+@api_login_required
+def remove_cart_item(item_id):
+    item = own_cart_item(item_id)
+    inventory.release(current_user.id, [item.product_id])
+    db.session.delete(item)
+    db.session.commit()
+    counters.invalidate()
+    return api_response(cart_json(current_user.id))
+
+
+# Orders
+
+def order_query():
+    return Order.query.options(db.selectinload(Order.items).joinedload(OrderItem.product))\
+        .filter(Order.user_id == current_user.id)
+
+
+@api.route('/orders')
+@api_login_required
+def list_orders():
+    try:
+        page = paginate(order_query(), [(Order.id, False)], page_size(),
+                        request.args.get('cursor'), lambda o: (o.id,))
+    except InvalidCursor:
+        abort(400, 'invalid cursor')
+    return api_response({
+        'orders': [order_json(o) for o in page.items],
+        'next_cursor': page.next_cursor,
+    })
+
+
+@api.route('/orders/<int:order_id>')
+@api_login_required
+def get_order(order_id):
+    return api_response(order_json(order_query().filter(Order.id == order_id).first_or_404()))
+
+
+@api.route('/orders', methods=['POST'])
+@api_login_required
+def create_order():
+    try:
+        order = orders.place_order(current_user.id)
+    except orders.OutOfStock as e:
+        return api_response({
+            'error': 'not enough stock',
+            'products': [{'id': p.id, 'title': p.title, 'stock': p.stock} for p in e.products],
+        }, 409)
+    if order is None:
+        abort(400, 'cart is empty')
+    counters.invalidate()
+    catalog_cache.invalidate_order(order.id)
+    return api_response(order_json(order_query().filter(Order.id == order.id).one()), 201)
@@ -1,67 +1,137 @@
-from flask import Flask, render_template, request, redirect, url_for, flash
+from datetime import datetime, timedelta
+import hmac
+import json
+import os
+
+import click
+from flask import Flask, Response, render_template, request, redirect, url_for, flash, abort, jsonify, send_file, stream_with_context
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
-from models import db, User, Product, Category, CartItem, Wishlist, Order, OrderItem
-from config import Config
+from models import db, User, Product, Category, CartItem, Wishlist, Order, OrderItem, ProductSales, StoreStat, ProductNeighbor, ContactMessage, ProductImport, Job, SUPERSEDED_INDEXES
+from config import configs
+from search import product_search
+from catalog import catalog_page
+from api import api
+from cache import catalog_cache
+from metrics import Instrumentation
+from pagination import paginate, InvalidCursor
+from covers import cover_images, source_version, CoverError, COVER_MAX_AGE
+from passwords import password_hasher, HashingBusy
+from identity import user_cache
+from jobs import job_queue
+import bestsellers
+import counters
+import orders
+import database
+import catalog_io
+import rollups
+import inventory
+import recommendations
+# Imported for its side effect: registers the mail job handlers with jobs.py
+import notifications  # noqa: F401
+import facets
+import sessions
 
 app = Flask(__name__)
-app.config.from_object(Config)
+app.config.from_object(configs[os.environ.get('APP_ENV', 'default')])
 
+database.init_app(app)
+sessions.init_app(app)
 db.init_app(app)
+user_cache.init_app(app)
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
+product_search.init_app(app)
+catalog_cache.init_app(app)
+cover_images.init_app(app)
+password_hasher.init_app(app)
+job_queue.init_app(app)
+instrumentation = Instrumentation(app)
+app.register_blueprint(api)
 
+# Identity fields only, usually from the per-worker cache
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return user_cache.get(int(user_id))
 
 # Home route
 @app.route('/')
+@catalog_cache.cached_page()
 def home():
-    categories = Category.query.all()
-    # Get best sellers (products with most orders) or just show first 8 products
-    try:
-        best_sellers = db.session.query(Product, db.func.count(OrderItem.id).label('order_count'))\
-            .outerjoin(OrderItem, Product.id == OrderItem.product_id)\
-            .group_by(Product.id)\
-            .order_by(db.desc('order_count'))\
-            .limit(8).all()
-    except:
-        best_sellers = [(p, 0) for p in Product.query.limit(8).all()]
+    # Passed uncalled so the cached category fragment skips it
+    categories = facets.category_facets
+    best_sellers = bestsellers.top_sellers(8, app.config['BESTSELLER_WINDOW'])
     
     return render_template('home.html', categories=categories, best_sellers=best_sellers)
 
 # Products routes
 @app.route('/products')
+@catalog_cache.cached_page()
 def products():
-    category_id = request.args.get('category', type=int)
-    search = request.args.get('search', '')
-    sort = request.args.get('sort', 'name_asc')
-    
-    query = Product.query
-    if category_id:
-        query = query.filter_by(category_id=category_id)
-    if search:
-        query = query.filter(Product.title.contains(search) | Product.author.contains(search))
-    
-    # Sorting
-    if sort == 'price_asc':
-        query = query.order_by(Product.price.asc())
-    elif sort == 'price_desc':
-        query = query.order_by(Product.price.desc())
-    elif sort == 'name_desc':
-        query = query.order_by(Product.title.desc())
-    else:  # name_asc
-        query = query.order_by(Product.title.asc())
-    
-    products = query.all()
-    categories = Category.query.all()
-    return render_template('products.html', products=products, categories=categories)
+    try:
+        page = catalog_page(request.args, app.config['PRODUCTS_PER_PAGE'])
+    except InvalidCursor:
+        abort(400)
+    return render_template('products.html', products=page.items, page=page,
+                           categories=facets.category_facets(request.args.get('search', '')))
+
+# JSON feed of the same listing for infinite scroll; follow next_cursor
+@app.route('/products/feed')
+def products_feed():
+    per_page = min(max(request.args.get('limit', app.config['PRODUCTS_PER_PAGE'], type=int), 1), 100)
+    try:
+        page = catalog_page(request.args, per_page)
+    except InvalidCursor:
+        abort(400)
+    return jsonify({
+        'products': [{
+            'id': p.id,
+            'title': p.title,
+            'author': p.author,
+            'price': p.price,
+            'stock': p.stock,
+            'category_id': p.category_id,
+            'image_url': p.image_url,
+            'url': url_for('product_detail', id=p.id),
+        } for p in page.items],
+        'next_cursor': page.next_cursor,
+    })
 
 @app.route('/product/<int:id>')
+@catalog_cache.cached_page()
 def product_detail(id):
     product = Product.query.get_or_404(id)
-    return render_template('product_detail.html', product=product)
+    return render_template('product_detail.html', product=product,
+                           available=inventory.available([product])[product.id],
+                           neighbors=recommendations.neighbors(product.id))
+
+# Too many password hashes already running or queued in this process
+@app.errorhandler(HashingBusy)
+def hashing_busy(e):
+    return 'The server is busy, please try again in a moment.', 503, {'Retry-After': '1'}
+
+# Resized, locally cached cover images; the v argument versions the URL by
+# the product's image_url so responses can be cached forever
+@app.route('/covers/<int:product_id>/<int:width>')
+def cover(product_id, width):
+    if width not in app.config['COVER_WIDTHS']:
+        abort(404)
+    product = Product.query.get_or_404(product_id)
+    if not product.image_url:
+        abort(404)
+    version = source_version(product.image_url)
+    if request.args.get('v') != version:
+        return redirect(url_for('cover', product_id=product_id, width=width, v=version))
+    resolved = cover_images.resolve(product.image_url, width)
+    if resolved is None:
+        # Not fetched yet; a job fetches it for later requests
+        db.session.commit()
+        return redirect(product.image_url)
+    path, mimetype = resolved
+    response = send_file(path, mimetype=mimetype, max_age=COVER_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
 
 # Authentication routes
 @app.route('/register', methods=['GET', 'POST'])
@@ -78,6 +148,7 @@ def register():
         user = User(username=username, email=email)
         user.set_password(password)
         db.session.add(user)
+        rollups.add(users=1)
         db.session.commit()
         
         flash('Registration successful! Please login.', 'success')
@@ -90,13 +161,24 @@ def login():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
+        retry_after = password_hasher.retry_after(username, request.remote_addr)
+        if retry_after:
+            flash(f'Too many failed login attempts. Try again in {(retry_after + 59) // 60} minutes.', 'danger')
+            return render_template('auth/login.html'), 429, {'Retry-After': str(retry_after)}
+        
         user = User.query.filter_by(username=username).first()
         
-        if user and user.check_password(password):
+        if password_hasher.authenticate(user, password):
+            # Keeps a hash upgraded to the current settings
+            db.session.commit()
+            password_hasher.login_succeeded(username)
+            sessions.regenerate()
+            user_cache.put(user)
             login_user(user)
             flash('Login successful!', 'success')
             return redirect(url_for('home'))
         
+        password_hasher.login_failed(username, request.remote_addr)
         flash('Invalid username or password', 'danger')
     
     return render_template('auth/login.html')
@@ -112,6 +194,14 @@ def logout():
 @app.route('/contact', methods=['GET', 'POST'])
 def contact():
     if request.method == 'POST':
+        # Kept in the outbox and mailed by a job, so the message survives a
+        # mail server outage
+        message = ContactMessage(name=request.form['name'], email=request.form['email'],
+                                 subject=request.form['subject'], message=request.form['message'])
+        db.session.add(message)
+        db.session.flush()
+        job_queue.enqueue('contact_message', {'message_id': message.id}, key=f'contact_message:{message.id}')
+        db.session.commit()
         flash('Thank you for contacting us! We will get back to you soon.', 'success')
         return redirect(url_for('contact'))
     return render_template('contact.html')
@@ -120,17 +210,26 @@ def contact():
 @app.route('/cart')
 @login_required
 def cart():
-    cart_items = CartItem.query.filter_by(user_id=current_user.id).all()
+    cart_items = orders.load_cart(current_user.id)
     total = sum(item.product.price * item.quantity for item in cart_items)
-    return render_template('cart.html', cart_items=cart_items, total=total)
+    available = inventory.available([item.product for item in cart_items], current_user.id)
+    return render_template('cart.html', cart_items=cart_items, total=total, available=available)
 
 @app.route('/add_to_cart/<int:product_id>', methods=['POST'])
 @login_required
 def add_to_cart(product_id):
     product = Product.query.get_or_404(product_id)
-    quantity = int(request.form.get('quantity', 1))
+    quantity = request.form.get('quantity', type=int) if 'quantity' in request.form else 1
+    if quantity is None or quantity < 1:
+        flash('Quantity must be a positive number.', 'warning')
+        return redirect(request.referrer or url_for('products'))
     
     cart_item = CartItem.query.filter_by(user_id=current_user.id, product_id=product_id).first()
+    try:
+        inventory.reserve(current_user.id, product_id, quantity + (cart_item.quantity if cart_item else 0))
+    except inventory.NotAvailable as e:
+        flash(f'Sorry, only {e.available} of {product.title} available right now.', 'warning')
+        return redirect(request.referrer or url_for('products'))
     
     if cart_item:
         cart_item.quantity += quantity
@@ -139,29 +238,38 @@ def add_to_cart(product_id):
         db.session.add(cart_item)
     
     db.session.commit()
+    counters.invalidate()
     flash('Product added to cart!', 'success')
     return redirect(request.referrer or url_for('products'))
 
 @app.route('/update_cart/<int:item_id>', methods=['POST'])
 @login_required
 def update_cart(item_id):
-    cart_item = CartItem.query.get_or_404(item_id)
-    quantity = int(request.form['quantity'])
+    cart_item = CartItem.query.filter_by(id=item_id, user_id=current_user.id).first_or_404()
+    quantity = request.form.get('quantity', type=int)
+    if quantity is None or quantity < 1:
+        flash('Quantity must be a positive number.', 'warning')
+        return redirect(url_for('cart'))
     
-    if quantity > 0:
-        cart_item.quantity = quantity
-    else:
-        db.session.delete(cart_item)
+    try:
+        inventory.reserve(current_user.id, cart_item.product_id, quantity)
+    except inventory.NotAvailable as e:
+        flash(f'Sorry, only {e.available} of {cart_item.product.title} available right now.', 'warning')
+        return redirect(url_for('cart'))
+    cart_item.quantity = quantity
     
     db.session.commit()
+    counters.invalidate()
     return redirect(url_for('cart'))
 
 @app.route('/remove_from_cart/<int:item_id>')
 @login_required
 def remove_from_cart(item_id):
-    cart_item = CartItem.query.get_or_404(item_id)
+    cart_item = CartItem.query.filter_by(id=item_id, user_id=current_user.id).first_or_404()
+    inventory.release(current_user.id, [cart_item.product_id])
     db.session.delete(cart_item)
     db.session.commit()
+    counters.invalidate()
     flash('Item removed from cart', 'success')
     return redirect(url_for('cart'))
 
@@ -169,16 +277,15 @@ def remove_from_cart(item_id):
 @app.context_processor
 def cart_count():
     if current_user.is_authenticated:
-        count = CartItem.query.filter_by(user_id=current_user.id).count()
-        wishlist_count = Wishlist.query.filter_by(user_id=current_user.id).count()
-        return {'cart_count': count, 'wishlist_count': wishlist_count}
+        return counters.nav_counts(current_user.id)
     return {'cart_count': 0, 'wishlist_count': 0}
 
 # Wishlist routes
 @app.route('/wishlist')
 @login_required
 def wishlist():
-    wishlist_items = Wishlist.query.filter_by(user_id=current_user.id).all()
+    wishlist_items = Wishlist.query.options(db.joinedload(Wishlist.product))\
+        .filter_by(user_id=current_user.id).all()
     return render_template('wishlist.html', wishlist_items=wishlist_items)
 
 @app.route('/add_to_wishlist/<int:product_id>')
@@ -190,6 +297,7 @@ def add_to_wishlist(product_id):
         wishlist_item = Wishlist(user_id=current_user.id, product_id=product_id)
         db.session.add(wishlist_item)
         db.session.commit()
+        counters.invalidate()
         flash('Added to wishlist!', 'success')
     else:
         flash('Already in wishlist!', 'info')
@@ -202,6 +310,7 @@ def remove_from_wishlist(item_id):
     wishlist_item = Wishlist.query.get_or_404(item_id)
     db.session.delete(wishlist_item)
     db.session.commit()
+    counters.invalidate()
     flash('Removed from wishlist', 'success')
     return redirect(url_for('wishlist'))
 
@@ -209,38 +318,35 @@ def remove_from_wishlist(item_id):
 @app.route('/checkout', methods=['GET', 'POST'])
 @login_required
 def checkout():
-    cart_items = CartItem.query.filter_by(user_id=current_user.id).all()
-    
-    if not cart_items:
-        flash('Your cart is empty', 'warning')
-        return redirect(url_for('products'))
-    
     if request.method == 'POST':
-        total = sum(item.product.price * item.quantity for item in cart_items)
-        order = Order(user_id=current_user.id, total=total, status='completed')
-        db.session.add(order)
+        try:
+            order = orders.place_order(current_user.id)
+        except orders.OutOfStock as e:
+            flash(f'Not enough stock for: {e}. Please update your cart.', 'danger')
+            return redirect(url_for('cart'))
         
-        for item in cart_items:
-            order_item = OrderItem(order=order, product_id=item.product_id, 
-                                   quantity=item.quantity, price=item.product.price)
-            db.session.add(order_item)
-            
-            product = Product.query.get(item.product_id)
-            product.stock -= item.quantity
-        
-        CartItem.query.filter_by(user_id=current_user.id).delete()
-        db.session.commit()
+        if order is None:
+            flash('Your cart is empty', 'warning')
+            return redirect(url_for('products'))
         
+        counters.invalidate()
+        catalog_cache.invalidate_order(order.id)
         flash('Order placed successfully!', 'success')
         return redirect(url_for('order_confirmation', order_id=order.id))
     
+    cart_items = orders.load_cart(current_user.id)
+    if not cart_items:
+        flash('Your cart is empty', 'warning')
+        return redirect(url_for('products'))
+    
     total = sum(item.product.price * item.quantity for item in cart_items)
     return render_template('checkout.html', cart_items=cart_items, total=total)
 
 @app.route('/order_confirmation/<int:order_id>')
 @login_required
 def order_confirmation(order_id):
-    order = Order.query.get_or_404(order_id)
+    order = Order.query.options(db.selectinload(Order.items).joinedload(OrderItem.product))\
+        .filter_by(id=order_id).first_or_404()
     return render_template('order_confirmation.html', order=order)
 
 # Admin routes
@@ -251,17 +357,16 @@ def admin_dashboard():
         flash('Access denied. Admin only.', 'danger')
         return redirect(url_for('home'))
     
-    total_products = Product.query.count()
-    total_orders = Order.query.count()
-    total_users = User.query.count()
-    total_revenue = db.session.query(db.func.sum(Order.total)).scalar() or 0
-    recent_orders = Order.query.order_by(Order.created_at.desc()).limit(5).all()
+    stats = rollups.totals()
+    recent_orders = Order.query.options(db.joinedload(Order.user).load_only(User.username))\
+        .order_by(Order.created_at.desc()).limit(5).all()
     
     return render_template('admin/dashboard.html', 
-                         total_products=total_products,
-                         total_orders=total_orders, 
-                         total_users=total_users,
-                         total_revenue=total_revenue,
+                         total_products=stats['products'],
+                         total_orders=stats['orders'], 
+                         total_users=stats['users'],
+                         total_revenue=stats['revenue'],
+                         trend=rollups.daily(app.config['DASHBOARD_TREND_DAYS']),
                          recent_orders=recent_orders)
 
 @app.route('/admin/products')
@@ -271,8 +376,13 @@ def admin_products():
         flash('Access denied. Admin only.', 'danger')
         return redirect(url_for('home'))
     
-    products = Product.query.all()
-    return render_template('admin/products.html', products=products)
+    try:
+        page = paginate(Product.query.options(db.joinedload(Product.category)),
+                        [(Product.id, True)], app.config['ADMIN_PRODUCTS_PER_PAGE'],
+                        request.args.get('cursor'), lambda p: (p.id,))
+    except InvalidCursor:
+        abort(400)
+    return render_template('admin/products.html', products=page.items, page=page)
 
 @app.route('/admin/product/add', methods=['GET', 'POST'])
 @login_required
@@ -292,7 +402,10 @@ def admin_add_product():
             image_url=request.form['image_url']
         )
         db.session.add(product)
+        rollups.add(products=1)
         db.session.commit()
+        product_search.index_product(product)
+        catalog_cache.clear()
         flash('Product added successfully!', 'success')
         return redirect(url_for('admin_products'))
     
@@ -317,6 +430,8 @@ def admin_edit_product(id):
         product.category_id = int(request.form['category_id'])
         product.image_url = request.form['image_url']
         db.session.commit()
+        product_search.index_product(product)
+        catalog_cache.clear()
         flash('Product updated successfully!', 'success')
         return redirect(url_for('admin_products'))
     
@@ -332,21 +447,102 @@ def admin_delete_product(id):
     
     product = Product.query.get_or_404(id)
     db.session.delete(product)
+    rollups.add(products=-1)
     db.session.commit()
+    product_search.remove_product(id)
+    catalog_cache.clear()
     flash('Product deleted successfully!', 'success')
     return redirect(url_for('admin_products'))
 
+@app.route('/admin/products/import', methods=['GET', 'POST'])
+@login_required
+def admin_import_products():
+    if not current_user.is_admin:
+        flash('Access denied. Admin only.', 'danger')
+        return redirect(url_for('home'))
+    
+    if request.method == 'POST':
+        upload = request.files.get('file')
+        if not upload or not upload.filename:
+            flash('Choose a CSV or JSONL file to import', 'warning')
+            return redirect(url_for('admin_import_products'))
+        fmt = 'jsonl' if upload.filename.lower().endswith(('.jsonl', '.ndjson')) else 'csv'
+        # Imported by a background job; the status page follows its progress
+        record = catalog_io.start_import(upload, fmt, create_categories='create_categories' in request.form)
+        return redirect(url_for('admin_import_status', import_id=record.id))
+    
+    return render_template('admin/import_products.html', record=None)
+
+@app.route('/admin/products/import/<int:import_id>')
+@login_required
+def admin_import_status(import_id):
+    if not current_user.is_admin:
+        flash('Access denied. Admin only.', 'danger')
+        return redirect(url_for('home'))
+    
+    record = ProductImport.query.get_or_404(import_id)
+    job = Job.query.filter_by(key=catalog_io.import_job_key(import_id)).first()
+    if record.finished_at:
+        status = 'done'
+    else:
+        status = job.status if job else 'failed'
+    errors = json.loads(record.errors) if record.errors else []
+    return render_template('admin/import_products.html', record=record, status=status,
+                           last_error=job.last_error if job else None, errors=errors)
+
+@app.route('/admin/products/export')
+@login_required
+def admin_export_products():
+    if not current_user.is_admin:
+        flash('Access denied. Admin only.', 'danger')
+        return redirect(url_for('home'))
+    
+    fmt = 'jsonl' if request.args.get('format') == 'jsonl' else 'csv'
+    mimetype = 'application/x-ndjson' if fmt == 'jsonl' else 'text/csv'
+    return Response(stream_with_context(catalog_io.export_rows(fmt)), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename=products.{fmt}'})
+
+@app.route('/admin/metrics')
+@login_required
+def admin_metrics():
+    if not current_user.is_admin:
+        flash('Access denied. Admin only.', 'danger')
+        return redirect(url_for('home'))
+    
+    routes, profiles = instrumentation.snapshot()
+    return render_template('admin/metrics.html', enabled=instrumentation.enabled,
+                           routes=routes, profiles=profiles)
+
+# Prometheus text format; scrapers authenticate with METRICS_TOKEN as a
+# bearer token, admins can also open it in the browser
+@app.route('/admin/metrics/prometheus')
+def admin_metrics_prometheus():
+    token = app.config['METRICS_TOKEN']
+    supplied = request.headers.get('Authorization', '')
+    if not (token and hmac.compare_digest(supplied, f'Bearer {token}')):
+        if not (current_user.is_authenticated and current_user.is_admin):
+            abort(403)
+    
+    return instrumentation.prometheus(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
 # User order history
 @app.route('/my-orders')
 @login_required
 def my_orders():
-    orders = Order.query.filter_by(user_id=current_user.id).order_by(Order.created_at.desc()).all()
-    return render_template('my_orders.html', orders=orders)
+    user_orders = Order.query.options(db.selectinload(Order.items).joinedload(OrderItem.product))\
+        .filter_by(user_id=current_user.id).order_by(Order.created_at.desc()).all()
+    return render_template('my_orders.html', orders=user_orders)
 
 # Initialize database
 def init_db():
     with app.app_context():
         db.create_all()
+        # create_all skips indexes on tables that already exist
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=db.engine, checkfirst=True)
+        for name in SUPERSEDED_INDEXES:
+            db.session.execute(db.text(f'DROP INDEX IF EXISTS {name}'))
         
         # Create categories if not exist
         if Category.query.count() == 0:
@@ -429,6 +625,129 @@ def init_db():
                 db.session.add(product)
         
         db.session.commit()
+        
+        # Databases created before the sales counters existed
+        if ProductSales.query.first() is None and OrderItem.query.first() is not None:
+            bestsellers.rebuild()
+        # Databases created before the dashboard rollups existed, or whose
+        # rows were just seeded above
+        if StoreStat.query.first() is None:
+            rollups.reconcile()
+        if ProductNeighbor.query.first() is None and OrderItem.query.first() is not None:
+            recommendations.rebuild()
+        product_search.setup()
+
+@app.cli.command('setup-search')
+@click.option('--rebuild', is_flag=True, help='Reindex every product even if the index exists')
+def setup_search_command(rebuild):
+    db.create_all()
+    product_search.setup()
+    if rebuild:
+        product_search.rebuild()
+        db.session.commit()
+    print(f'Search index ready ({product_search.backend.name})')
+
+@app.cli.command('purge-search-changes')
+@click.option('--days', default=7, show_default=True, help='Keep changes logged more recently')
+def purge_search_changes_command(days):
+    db.create_all()
+    purged = product_search.purge_changes(datetime.utcnow() - timedelta(days=days))
+    print(f'Purged {purged} search index changes')
+
+@app.cli.command('rebuild-bestsellers')
+def rebuild_bestsellers_command():
+    db.create_all()
+    ranked = bestsellers.rebuild()
+    print(f'Rebuilt best-seller counters for {ranked} products')
+
+@app.cli.command('rebuild-recommendations')
+def rebuild_recommendations_command():
+    db.create_all()
+    rows = recommendations.rebuild()
+    print(f'Rebuilt recommendations, {rows} neighbor rows')
+
+@app.cli.command('reconcile-stats')
+def reconcile_stats_command():
+    db.create_all()
+    drift = rollups.reconcile()
+    for name, stored, actual in drift:
+        print(f'{name}: stored {stored}, actual {actual}')
+    print(f'Rebuilt dashboard rollups, {len(drift)} drifted values corrected')
+
+@app.cli.command('release-holds')
+@click.option('--batch-size', default=1000, show_default=True)
+@click.option('--every', type=float, help='Keep running, sweeping every this many seconds')
+def release_holds_command(batch_size, every):
+    db.create_all()
+    if every:
+        inventory.sweep(every, batch_size)
+    released = inventory.release_expired(batch_size)
+    print(f'Released {released} expired stock holds')
+
+@app.cli.command('run-jobs')
+@click.option('--once', is_flag=True, help='Run the jobs that are due now and exit')
+@click.option('--poll', default=1.0, show_default=True, help='Seconds between checks for due jobs')
+def run_jobs_command(once, poll):
+    db.create_all()
+    if not once:
+        job_queue.work(poll)
+    print(f'Ran {job_queue.run_pending()} jobs')
+
+@app.cli.command('purge-jobs')
+@click.option('--days', default=7, show_default=True, help='Keep jobs that finished more recently')
+def purge_jobs_command(days):
+    db.create_all()
+    purged = job_queue.purge(datetime.utcnow() - timedelta(days=days))
+    print(f'Purged {purged} finished jobs')
+
+@app.cli.command('fetch-covers')
+def fetch_covers_command():
+    fetched = failed = 0
+    urls = db.session.query(Product.image_url).filter(Product.image_url.isnot(None), Product.image_url != '')\
+        .distinct().execution_options(yield_per=1000)
+    for url, in urls:
+        if cover_images.digest_for(url):
+            continue
+        try:
+            cover_images.fetch(url)
+            fetched += 1
+        except CoverError as e:
+            failed += 1
+            print(e)
+    print(f'Fetched {fetched} covers, {failed} failed')
+
+@app.cli.command('purge-sessions')
+def purge_sessions_command():
+    db.create_all()
+    store = getattr(app.session_interface, 'store', None)
+    if store is None:
+        print('Sessions are kept in cookies; nothing to purge')
+        return
+    print(f'Purged {store.purge(datetime.utcnow())} expired sessions')
+
+@app.cli.command('import-products')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), help='Defaults to the file extension')
+@click.option('--batch-size', default=1000, show_default=True)
+@click.option('--create-categories', is_flag=True, help='Create categories named in the feed')
+def import_products_command(path, fmt, batch_size, create_categories):
+    db.create_all()
+    fmt = fmt or ('jsonl' if path.lower().endswith(('.jsonl', '.ndjson')) else 'csv')
+    progress = lambda r: print(f'{r.rows} rows: {r.inserted} added, {r.updated} updated, '
+                               f'{r.error_count} rejected', flush=True)
+    with open(path, encoding='utf-8-sig', newline='') as stream:
+        report = catalog_io.import_products(stream, fmt, batch_size, create_categories, progress)
+    for line, message in report.errors:
+        print(f'line {line}: {message}')
+
+@app.cli.command('export-products')
+@click.argument('path', type=click.Path(dir_okay=False, writable=True))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), help='Defaults to the file extension')
+def export_products_command(path, fmt):
+    fmt = fmt or ('jsonl' if path.lower().endswith(('.jsonl', '.ndjson')) else 'csv')
+    with open(path, 'w', encoding='utf-8', newline='') as out:
+        for chunk in catalog_io.export_rows(fmt):
+            out.write(chunk)
 
 if __name__ == '__main__':
     init_db()
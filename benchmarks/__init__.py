@@ -0,0 +1 @@
+# Load benchmarks for the bookstore: `python -m benchmarks --help`
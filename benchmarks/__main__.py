@@ -0,0 +1,69 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+# Usage:
+#
+#     python -m benchmarks --products 200000 --orders 50000 --save-baseline base.json
+#     python -m benchmarks --products 200000 --orders 50000 --baseline base.json
+#
+# Runs against a fresh SQLite database in a temporary directory unless
+# --database points somewhere else. The database is configured before the
+# app is imported, so DATABASE_URL in the environment is never touched.
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks')
+    parser.add_argument('--products', type=int, default=10000)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--orders', type=int, default=5000)
+    parser.add_argument('--carts', type=int, default=200)
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--database', help='SQLAlchemy URL (default: temporary SQLite file)')
+    parser.add_argument('--no-cache', action='store_true', help='disable the catalog page cache')
+    parser.add_argument('--output', help='write results as JSON')
+    parser.add_argument('--save-baseline', metavar='PATH', help='write results as a new baseline')
+    parser.add_argument('--baseline', metavar='PATH', help='compare against a saved baseline')
+    args = parser.parse_args(argv)
+
+    if args.database:
+        os.environ['DATABASE_URL'] = args.database
+    else:
+        directory = tempfile.mkdtemp(prefix='bookstore-bench-')
+        os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(directory, 'bench.db')
+    if args.no_cache:
+        os.environ['CACHE_BACKEND'] = 'none'
+    # The harness runs jobs itself, outside the timed requests
+    os.environ['JOBS_IN_PROCESS'] = 'false'
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from app import app, init_db
+    from benchmarks import seed, harness, report
+
+    init_db()
+    start = time.perf_counter()
+    with app.app_context():
+        usernames = seed.seed(args.products, args.users, args.orders, args.carts, args.seed)
+    print(f'seeded in {time.perf_counter() - start:.1f}s')
+
+    start = time.perf_counter()
+    samples = harness.run(app, usernames, args.iterations, args.seed)
+    print(f'ran {args.iterations} iterations in {time.perf_counter() - start:.1f}s\n')
+
+    parameters = {k: getattr(args, k) for k in ('products', 'users', 'orders', 'carts',
+                                                'iterations', 'seed', 'no_cache')}
+    result = report.build(samples, parameters)
+    baseline = report.load(args.baseline) if args.baseline else None
+    print(report.render(result, baseline))
+
+    if args.output:
+        report.save(result, args.output)
+    if args.save_baseline:
+        report.save(result, args.save_baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+# Checkout stress test: many buyers, each with a cart of several contested
+# titles, check out at the same moment through the site and the JSON API.
+# Carts are written straight to the cart table without stock holds, so the
+# conditional stock UPDATE in orders.place_order() is the only thing
+# standing between them and an oversell.
+#
+#     python -m benchmarks.checkout_stress --buyers 200 --titles 5 --stock 40
+#
+# Prints outcomes and per-step latency percentiles and exits non-zero if
+# any title was oversold or went negative, or if an order was placed for
+# only part of a cart.
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.checkout_stress')
+    parser.add_argument('--buyers', type=int, default=200)
+    parser.add_argument('--titles', type=int, default=5, help='contested titles')
+    parser.add_argument('--stock', type=int, default=40, help='initial stock of each title')
+    parser.add_argument('--max-lines', type=int, default=3, help='most titles in one cart')
+    parser.add_argument('--max-quantity', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--database', help='SQLAlchemy URL (default: temporary SQLite file)')
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp(prefix='bookstore-checkout-')
+    os.environ['DATABASE_URL'] = args.database or 'sqlite:///' + os.path.join(directory, 'bench.db')
+    os.environ.setdefault('CACHE_BACKEND', 'none')
+    os.environ.setdefault('JOBS_IN_PROCESS', 'false')
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from app import app, init_db
+    from models import db, User, Product, CartItem, Order, OrderItem
+    from benchmarks import seed, report
+
+    rng = random.Random(args.seed)
+    app.config['PROPAGATE_EXCEPTIONS'] = False
+    init_db()
+    with app.app_context():
+        usernames = seed.seed(max(args.titles, 10), args.buyers, 0, 0, log=lambda *a: None)
+        products = Product.query.order_by(Product.id).limit(args.titles).all()
+        for product in products:
+            product.stock = args.stock
+        title_ids = [p.id for p in products]
+        user_ids = dict(db.session.query(User.username, User.id).filter(User.username.in_(usernames)))
+        carts = {}
+        for username in usernames:
+            lines = rng.sample(title_ids, rng.randint(1, min(args.max_lines, len(title_ids))))
+            carts[user_ids[username]] = {pid: rng.randint(1, args.max_quantity) for pid in lines}
+        db.session.execute(db.insert(CartItem), [
+            {'user_id': user_id, 'product_id': pid, 'quantity': quantity}
+            for user_id, cart in carts.items() for pid, quantity in cart.items()
+        ])
+        db.session.commit()
+
+    clients = []
+    for username in usernames:
+        client = app.test_client()
+        client.post('/login', data={'username': username, 'password': seed.PASSWORD})
+        clients.append(client)
+
+    samples = defaultdict(list)
+    outcomes = defaultdict(int)
+    lock = threading.Lock()
+    barrier = threading.Barrier(len(clients))
+
+    def buyer(client, use_api):
+        barrier.wait()
+        step = 'api_checkout' if use_api else 'checkout'
+        start = time.perf_counter()
+        response = client.post('/api/v1/orders' if use_api else '/checkout')
+        elapsed = time.perf_counter() - start
+        if use_api:
+            bought = response.status_code == 201
+        else:
+            bought = '/order_confirmation/' in response.headers.get('Location', '')
+        with lock:
+            samples[step].append((elapsed, 0))
+            if response.status_code >= 500:
+                outcomes['errors'] += 1
+            else:
+                outcomes['bought' if bought else 'refused'] += 1
+
+    threads = [threading.Thread(target=buyer, args=(client, i % 2 == 1)) for i, client in enumerate(clients)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    problems = []
+    with app.app_context():
+        stock = dict(db.session.query(Product.id, Product.stock).filter(Product.id.in_(title_ids)))
+        sold = dict(db.session.query(OrderItem.product_id, db.func.sum(OrderItem.quantity))
+                    .filter(OrderItem.product_id.in_(title_ids)).group_by(OrderItem.product_id))
+        for pid in title_ids:
+            if stock[pid] < 0 or (sold.get(pid) or 0) + stock[pid] != args.stock:
+                problems.append(f'title {pid}: sold {sold.get(pid) or 0}, {stock[pid]} left of {args.stock}')
+        # Each order holds exactly its buyer's cart, and a refused buyer
+        # keeps the whole cart
+        ordered = defaultdict(dict)
+        for user_id, pid, quantity in db.session.query(Order.user_id, OrderItem.product_id, OrderItem.quantity)\
+                .join(OrderItem, OrderItem.order_id == Order.id):
+            ordered[user_id][pid] = quantity
+        remaining = defaultdict(dict)
+        for user_id, pid, quantity in db.session.query(CartItem.user_id, CartItem.product_id, CartItem.quantity):
+            remaining[user_id][pid] = quantity
+        for user_id, cart in carts.items():
+            if ordered[user_id] and (ordered[user_id] != cart or remaining[user_id]):
+                problems.append(f'user {user_id}: ordered {ordered[user_id]} from cart {cart}')
+            elif not ordered[user_id] and remaining[user_id] != cart:
+                problems.append(f'user {user_id}: refused but cart is now {remaining[user_id]}')
+        orders_placed = Order.query.count()
+
+    print(f'{args.buyers} buyers, {args.titles} titles with {args.stock} each, {elapsed:.1f}s')
+    for name in ('bought', 'refused', 'errors'):
+        print(f'  {name:<22}{outcomes[name]:>6}')
+    print(f'  {"orders":<22}{orders_placed:>6}')
+    for pid in title_ids:
+        print(f'  title {pid:<16}{sold.get(pid) or 0:>6} sold {stock[pid]:>6} left')
+    print()
+    print(f'{"step":<14}{"requests":>10}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"max ms":>10}')
+    for step, s in report.summarize(samples).items():
+        slowest = max(v[0] for v in samples[step]) * 1000
+        print(f'{step:<14}{s["requests"]:>10}{s["p50_ms"]:>10.1f}{s["p95_ms"]:>10.1f}{s["p99_ms"]:>10.1f}{slowest:>10.1f}')
+
+    if problems or outcomes['errors'] or orders_placed != outcomes['bought']:
+        print('\nFAILED')
+        for problem in problems[:20]:
+            print(f'  {problem}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
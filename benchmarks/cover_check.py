@@ -0,0 +1,110 @@
+import io
+import os
+import sys
+import tempfile
+
+# Checks the /covers route end to end against a fixture image, with no
+# network access: the fixture is stored as if fetched from a product's
+# image_url, then requested through the route. A second product's cover,
+# never fetched, checks that a miss redirects and queues one fetch job.
+#
+#     python -m benchmarks.cover_check
+#
+# Exits non-zero listing every check that failed. Needs Pillow.
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'cover.png')
+SOURCE_URL = 'https://covers.invalid/fixture/cover.png'
+# Fails without touching the network: only http and https are fetched
+MISSING_URL = 'ftp://covers.invalid/fixture/missing.png'
+
+
+def main():
+    directory = tempfile.mkdtemp(prefix='bookstore-covers-')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(directory, 'check.db')
+    os.environ.setdefault('CACHE_BACKEND', 'none')
+    os.environ['JOBS_IN_PROCESS'] = 'false'
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from app import app, init_db
+    from models import db, Product, Job
+    from covers import Image, cover_images, source_version
+    from jobs import job_queue
+
+    if Image is None:
+        print('Pillow is not installed (pip install -r requirements.txt)')
+        sys.exit(1)
+
+    app.config['COVER_DIR'] = os.path.join(directory, 'covers')
+    init_db()
+    with app.app_context():
+        product, missing = Product.query.order_by(Product.id).limit(2).all()
+        product.image_url = SOURCE_URL
+        missing.image_url = MISSING_URL
+        db.session.commit()
+        product_id, missing_id = product.id, missing.id
+        with open(FIXTURE, 'rb') as f:
+            cover_images.store(SOURCE_URL, f.read())
+    with Image.open(FIXTURE) as fixture:
+        fixture_width, fixture_height = fixture.size
+
+    failures = []
+
+    def check(name, ok, detail=''):
+        print(f'{"ok" if ok else "FAIL":<6}{name}' + (f' ({detail})' if detail and not ok else ''))
+        if not ok:
+            failures.append(name)
+
+    client = app.test_client()
+    width = 100
+    url = f'/covers/{product_id}/{width}?v={source_version(SOURCE_URL)}'
+
+    response = client.get(url)
+    check('cover is served', response.status_code == 200, response.status_code)
+    check('cover is a JPEG', response.mimetype == 'image/jpeg', response.mimetype)
+    if response.status_code == 200:
+        with Image.open(io.BytesIO(response.data)) as image:
+            expected = (width, fixture_height * width // fixture_width)
+            check('cover is resized', image.size == expected, f'{image.size} != {expected}')
+            check('cover bytes are a JPEG', image.format == 'JPEG', image.format)
+    cache_control = response.headers.get('Cache-Control', '')
+    check('cached as immutable', 'immutable' in cache_control and 'public' in cache_control, cache_control)
+
+    etag = response.headers.get('ETag')
+    check('response has an ETag', bool(etag))
+    if etag:
+        response = client.get(url, headers={'If-None-Match': etag})
+        check('If-None-Match gives 304', response.status_code == 304, response.status_code)
+
+    response = client.get(f'/covers/{product_id}/123?v={source_version(SOURCE_URL)}')
+    check('width outside COVER_WIDTHS is 404', response.status_code == 404, response.status_code)
+
+    response = client.get(f'/covers/{product_id}/{width}')
+    check('missing v redirects to the versioned URL',
+          response.status_code in (301, 302) and response.headers.get('Location', '').endswith(url),
+          f'{response.status_code} {response.headers.get("Location")}')
+
+    def fetch_jobs():
+        with app.app_context():
+            return Job.query.filter_by(kind='fetch_cover').count()
+
+    missing_url = f'/covers/{missing_id}/{width}?v={source_version(MISSING_URL)}'
+    response = client.get(missing_url)
+    check('missing cover redirects to image_url',
+          response.status_code == 302 and response.headers.get('Location') == MISSING_URL,
+          f'{response.status_code} {response.headers.get("Location")}')
+    check('missing cover queues a fetch', fetch_jobs() == 1, fetch_jobs())
+    client.get(missing_url)
+    check('fetch is queued once', fetch_jobs() == 1, fetch_jobs())
+    with app.app_context():
+        job_queue.run_pending()
+    response = client.get(missing_url)
+    check('failed fetch still redirects', response.status_code == 302, response.status_code)
+    check('failed fetch is not retried at once', fetch_jobs() == 1, fetch_jobs())
+
+    if failures:
+        print(f'\n{len(failures)} cover checks failed')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
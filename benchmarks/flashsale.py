@@ -0,0 +1,111 @@
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+# Flash-sale simulation: many shoppers race to cart and buy one title with
+# little stock. Each shopper adds one copy to the cart (placing a stock
+# hold) and, if the hold was granted, checks out.
+#
+#     python -m benchmarks.flashsale --shoppers 200 --stock 25
+#
+# Prints per-step latency percentiles and exits non-zero if more copies
+# were sold than were in stock, or if stock went negative.
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.flashsale')
+    parser.add_argument('--shoppers', type=int, default=200)
+    parser.add_argument('--stock', type=int, default=25)
+    parser.add_argument('--database', help='SQLAlchemy URL (default: temporary SQLite file)')
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp(prefix='bookstore-flashsale-')
+    os.environ['DATABASE_URL'] = args.database or 'sqlite:///' + os.path.join(directory, 'bench.db')
+    os.environ.setdefault('CACHE_BACKEND', 'none')
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from app import app, init_db
+    from models import db, Product, OrderItem
+    from benchmarks import seed, report
+
+    app.config['PROPAGATE_EXCEPTIONS'] = False
+    init_db()
+    with app.app_context():
+        usernames = seed.seed(10, args.shoppers, 0, 0, log=lambda *a: None)
+        product = Product.query.order_by(Product.id).first()
+        product.stock = args.stock
+        db.session.commit()
+        product_id = product.id
+
+    clients = []
+    for username in usernames:
+        client = app.test_client()
+        client.post('/login', data={'username': username, 'password': seed.PASSWORD})
+        with client.session_transaction() as session:
+            session.pop('_flashes', None)
+        clients.append(client)
+
+    samples = defaultdict(list)
+    outcomes = defaultdict(int)
+    lock = threading.Lock()
+    barrier = threading.Barrier(len(clients))
+
+    def timed(step, client, url):
+        start = time.perf_counter()
+        response = client.post(url)
+        elapsed = time.perf_counter() - start
+        with lock:
+            samples[step].append((elapsed, 0))
+            if response.status_code >= 500:
+                outcomes['errors'] += 1
+        return response
+
+    def shopper(client):
+        barrier.wait()
+        timed('add_to_cart', client, f'/add_to_cart/{product_id}')
+        with client.session_transaction() as session:
+            held = any(category == 'success' for category, _ in session.get('_flashes', []))
+            session.pop('_flashes', None)
+        if not held:
+            with lock:
+                outcomes['refused_at_cart'] += 1
+            return
+        response = timed('checkout', client, '/checkout')
+        with lock:
+            outcomes['bought' if '/order_confirmation/' in response.headers.get('Location', '')
+                     else 'refused_at_checkout'] += 1
+
+    threads = [threading.Thread(target=shopper, args=(client,)) for client in clients]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    with app.app_context():
+        stock = db.session.get(Product, product_id).stock
+        sold = db.session.query(db.func.coalesce(db.func.sum(OrderItem.quantity), 0))\
+            .filter(OrderItem.product_id == product_id).scalar()
+
+    print(f'{args.shoppers} shoppers, {args.stock} in stock, {elapsed:.1f}s')
+    for name in ('bought', 'refused_at_cart', 'refused_at_checkout', 'errors'):
+        print(f'  {name:<22}{outcomes[name]:>6}')
+    print(f'  {"sold":<22}{sold:>6}')
+    print(f'  {"stock left":<22}{stock:>6}\n')
+    print(f'{"step":<14}{"requests":>10}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"max ms":>10}')
+    for step, s in report.summarize(samples).items():
+        slowest = max(v[0] for v in samples[step]) * 1000
+        print(f'{step:<14}{s["requests"]:>10}{s["p50_ms"]:>10.1f}{s["p95_ms"]:>10.1f}{s["p99_ms"]:>10.1f}{slowest:>10.1f}')
+
+    if sold > args.stock or stock < 0 or sold + stock != args.stock:
+        print('\nOVERSOLD')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+import random
+import re
+import time
+from collections import defaultdict
+
+from querycount import assert_max_queries
+from benchmarks.seed import WORDS, PASSWORD
+
+# Drives the Flask test client through browse, search, cart, checkout,
+# order-history, wishlist and admin dashboard flows, recording latency and SQL statement count for every
+# request under a step name. Background jobs run between requests, as a
+# separate worker would run them, and are recorded under 'jobs'.
+#
+# Every step has a budget of SQL statements per request, cold cache
+# included; a request over budget stops the run with the statements it
+# executed, so N+1 regressions fail the benchmark. Statements on the
+# sessions bind (loading and saving the server-side session) count too.
+# None of the budgets depend on the size of the catalog, the cart or the
+# order history.
+
+CURSOR_RE = re.compile(r'cursor=([\w-]+)')
+
+QUERY_BUDGETS = {
+    'login': 4,
+    'home': 5,
+    'products': 3,
+    'products_next_page': 3,
+    'product_detail': 4,
+    # FTS5 needs 6; the in-memory backend also checks its change log and
+    # writes the matches to a temporary table, for the listing and facets
+    'search': 9,
+    'add_to_cart': 9,
+    'cart': 5,
+    'checkout_page': 2,
+    'checkout': 17,
+    'order_confirmation': 5,
+    'my_orders': 5,
+    'wishlist': 4,
+    'admin_dashboard': 6,
+    # Both jobs of one checkout
+    'jobs': 15,
+}
+
+
+class Recorder:
+    def __init__(self, app):
+        self.app = app
+        self.samples = defaultdict(list)
+
+    def request(self, step, client, method, url, **kwargs):
+        with self.app.app_context(), assert_max_queries(QUERY_BUDGETS[step]) as queries:
+            start = time.perf_counter()
+            response = client.open(url, method=method, **kwargs)
+            elapsed = time.perf_counter() - start
+        if response.status_code >= 400:
+            raise RuntimeError(f'{step}: {method} {url} returned {response.status_code}')
+        self.samples[step].append((elapsed, queries.count))
+        return response
+
+    def run_jobs(self):
+        from jobs import job_queue
+        with self.app.app_context(), assert_max_queries(QUERY_BUDGETS['jobs']) as queries:
+            start = time.perf_counter()
+            job_queue.run_pending()
+            elapsed = time.perf_counter() - start
+        self.samples['jobs'].append((elapsed, queries.count))
+
+
+def _typo(rng, word):
+    i = rng.randrange(len(word) - 1)
+    return word[:i] + word[i + 1] + word[i] + word[i + 2:]
+
+
+def browse(rec, client, rng, product_ids, category_ids):
+    rec.request('home', client, 'GET', '/')
+    sort = rng.choice(['name_asc', 'name_desc', 'price_asc', 'price_desc'])
+    url = f'/products?sort={sort}&category={rng.choice(category_ids)}'
+    response = rec.request('products', client, 'GET', url)
+    # Follow a few "next page" links, as a reader paging through a category
+    for _ in range(rng.randint(0, 3)):
+        match = CURSOR_RE.findall(response.get_data(as_text=True))
+        if not match:
+            break
+        response = rec.request('products_next_page', client, 'GET', f'{url}&cursor={match[-1]}')
+    rec.request('product_detail', client, 'GET', f'/product/{rng.choice(product_ids)}')
+
+
+def search(rec, client, rng):
+    word = rng.choice(WORDS)
+    term = rng.choice([word, word[:4], _typo(rng, word) if len(word) > 4 else word])
+    rec.request('search', client, 'GET', f'/products?search={term}')
+
+
+def login(rec, client, username):
+    rec.request('login', client, 'POST', '/login', data={'username': username, 'password': PASSWORD})
+
+
+def cart(rec, client, rng, product_ids):
+    for product_id in rng.sample(product_ids, 2):
+        rec.request('add_to_cart', client, 'POST', f'/add_to_cart/{product_id}', data={'quantity': 1})
+    rec.request('cart', client, 'GET', '/cart')
+
+
+def checkout(rec, client, rng, product_ids):
+    cart(rec, client, rng, product_ids)
+    rec.request('checkout_page', client, 'GET', '/checkout')
+    response = rec.request('checkout', client, 'POST', '/checkout')
+    location = response.headers.get('Location', '')
+    if '/order_confirmation/' in location:
+        rec.request('order_confirmation', client, 'GET', location)
+    rec.run_jobs()
+
+
+def my_orders(rec, client):
+    rec.request('my_orders', client, 'GET', '/my-orders')
+
+
+def wishlist(rec, client):
+    rec.request('wishlist', client, 'GET', '/wishlist')
+
+
+def admin_dashboard(rec, client):
+    rec.request('admin_dashboard', client, 'GET', '/admin')
+
+
+def run(app, usernames, iterations=200, seed=0, log=print):
+    from models import Product, Category
+    from search import product_search
+
+    rng = random.Random(seed)
+    with app.app_context():
+        # As init_db does; not charged to the first search
+        product_search.setup()
+        # Only products that can actually be bought, so checkouts succeed
+        product_ids = [pid for pid, in Product.query.with_entities(Product.id)
+                       .filter(Product.stock >= 20).limit(5000)]
+        category_ids = [cid for cid, in Category.query.with_entities(Category.id)]
+
+    rec = Recorder(app)
+    anonymous = app.test_client()
+    shoppers = []
+    for username in rng.sample(usernames, min(20, len(usernames))):
+        client = app.test_client()
+        login(rec, client, username)
+        shoppers.append(client)
+    # The admin account init_db creates
+    admin = app.test_client()
+    rec.request('login', admin, 'POST', '/login', data={'username': 'admin', 'password': 'admin123'})
+
+    for i in range(iterations):
+        roll = rng.random()
+        if roll < 0.4:
+            browse(rec, anonymous, rng, product_ids, category_ids)
+        elif roll < 0.6:
+            search(rec, anonymous, rng)
+        elif roll < 0.75:
+            client = rng.choice(shoppers)
+            browse(rec, client, rng, product_ids, category_ids)
+            cart(rec, client, rng, product_ids)
+        elif roll < 0.9:
+            checkout(rec, rng.choice(shoppers), rng, product_ids)
+        elif roll < 0.95:
+            client = rng.choice(shoppers)
+            my_orders(rec, client)
+            wishlist(rec, client)
+        else:
+            admin_dashboard(rec, admin)
+        if (i + 1) % 50 == 0:
+            log(f'{i + 1}/{iterations} iterations')
+    return rec.samples
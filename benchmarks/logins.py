@@ -0,0 +1,103 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Login throughput per core for a few password hash settings:
+#
+#     python -m benchmarks.logins --threads 8 --duration 5
+#     python -m benchmarks.logins --methods scrypt:16384:8:1 pbkdf2:sha256:300000
+#
+# For each method, "verify/s" is raw hash checks per second on one thread
+# and "logins/s" is successful POST /login requests per second from
+# --threads concurrent clients through the hashing pool. Each method runs in
+# its own subprocess since configuration is read when the app is imported.
+
+METHODS = ('scrypt', 'scrypt:16384:8:1', 'pbkdf2:sha256:600000', 'pbkdf2:sha256:100000')
+
+
+def cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def worker(args):
+    from werkzeug.security import check_password_hash
+    from app import app, init_db
+    from passwords import password_hasher
+    from benchmarks import seed
+
+    init_db()
+    with app.app_context():
+        usernames = seed.seed(10, args.threads, 0, 0, log=lambda *a: None)
+        password_hash = password_hasher.hash(seed.PASSWORD)
+
+    checks = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < min(args.duration, 2.0):
+        check_password_hash(password_hash, seed.PASSWORD)
+        checks += 1
+    verify_rate = checks / (time.perf_counter() - start)
+
+    counts = {'ok': 0, 'failed': 0}
+    lock = threading.Lock()
+    barrier = threading.Barrier(args.threads)
+    deadline = [0.0]
+
+    def client_loop(username):
+        client = app.test_client()
+        barrier.wait()
+        while time.perf_counter() < deadline[0]:
+            response = client.post('/login', data={'username': username, 'password': seed.PASSWORD})
+            with lock:
+                counts['ok' if response.status_code == 302 else 'failed'] += 1
+            client.get('/logout')
+
+    threads = [threading.Thread(target=client_loop, args=(username,)) for username in usernames]
+    deadline[0] = time.perf_counter() + args.duration
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    print(json.dumps({'verify_per_second': verify_rate, 'logins_per_second': counts['ok'] / elapsed,
+                      'failed': counts['failed']}))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.logins')
+    parser.add_argument('--methods', nargs='+', default=METHODS)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker:
+        worker(args)
+        return
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    used = min(cores(), args.threads)
+    print(f'{cores()} cores available, {args.threads} client threads\n')
+    print(f'{"method":<24}{"verify/s":>10}{"logins/s":>10}{"per core":>10}{"failed":>8}')
+    for method in args.methods:
+        directory = tempfile.mkdtemp(prefix='bookstore-logins-')
+        env = dict(os.environ, PASSWORD_HASH_METHOD=method, CACHE_BACKEND='none',
+                   DATABASE_URL='sqlite:///' + os.path.join(directory, 'bench.db'))
+        command = [sys.executable, '-m', 'benchmarks.logins', '--worker',
+                   '--threads', str(args.threads), '--duration', str(args.duration)]
+        output = subprocess.run(command, env=env, cwd=root, check=True,
+                                capture_output=True, text=True).stdout
+        r = json.loads(output.strip().splitlines()[-1])
+        print(f'{method:<24}{r["verify_per_second"]:>10.1f}{r["logins_per_second"]:>10.1f}'
+              f'{r["logins_per_second"] / used:>10.1f}{r["failed"]:>8}')
+
+
+if __name__ == '__main__':
+    main()
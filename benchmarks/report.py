@@ -0,0 +1,69 @@
+import json
+import math
+import platform
+from datetime import datetime
+
+
+def percentile(sorted_values, p):
+    # Nearest-rank percentile
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize(samples):
+    steps = {}
+    for step, values in sorted(samples.items()):
+        latencies = sorted(v[0] * 1000 for v in values)
+        steps[step] = {
+            'requests': len(values),
+            'mean_ms': sum(latencies) / len(latencies),
+            'p50_ms': percentile(latencies, 50),
+            'p95_ms': percentile(latencies, 95),
+            'p99_ms': percentile(latencies, 99),
+            'queries_per_request': sum(v[1] for v in values) / len(values),
+        }
+    return steps
+
+
+def build(samples, parameters):
+    return {
+        'created_at': datetime.utcnow().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'parameters': parameters,
+        'steps': summarize(samples),
+    }
+
+
+def save(result, path):
+    with open(path, 'w') as f:
+        json.dump(result, f, indent=2, sort_keys=True)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def _change(new, old):
+    if not old:
+        return ''
+    return f'{(new - old) / old * 100:+.0f}%'
+
+
+def render(result, baseline=None):
+    header = f'{"step":<20}{"reqs":>6}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}{"queries":>9}'
+    if baseline:
+        header += f'{"p95 vs base":>13}{"queries vs base":>17}'
+    lines = [header, '-' * len(header)]
+    base_steps = baseline['steps'] if baseline else {}
+    for step, s in result['steps'].items():
+        line = (f'{step:<20}{s["requests"]:>6}{s["p50_ms"]:>9.2f}{s["p95_ms"]:>9.2f}'
+                f'{s["p99_ms"]:>9.2f}{s["queries_per_request"]:>9.1f}')
+        if baseline:
+            old = base_steps.get(step)
+            line += f'{_change(s["p95_ms"], old and old["p95_ms"]):>13}'
+            line += f'{_change(s["queries_per_request"], old and old["queries_per_request"]):>17}'
+        lines.append(line)
+    return '\n'.join(lines)
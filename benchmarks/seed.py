@@ -0,0 +1,129 @@
+import random
+from datetime import datetime, timedelta
+
+from passwords import password_hasher
+from models import db, User, Product, Category, CartItem, Wishlist, Order, OrderItem
+import bestsellers
+import recommendations
+import rollups
+
+# Synthetic catalog generator. Rows go in through executemany batches of
+# BATCH rows instead of one db.session.add per object, so a few hundred
+# thousand products take seconds rather than minutes.
+
+BATCH = 5000
+PASSWORD = 'benchmark'
+
+WORDS = (
+    'shadow night river garden empire silent winter golden lost secret city stone '
+    'fire glass ocean star kingdom dream house forest road iron queen storm light '
+    'hidden broken last first wild dark crimson paper machine mountain island '
+    'memory history science journey letters voice bridge clock atlas orbit'
+).split()
+FIRST_NAMES = 'Ada Alan Maya Omar Lena Ivan Nora Hugo Iris Theo Zara Felix Mira Otto'.split()
+LAST_NAMES = 'Hart Stone Reyes Novak Okafor Lindqvist Moreau Tanaka Ferreira Quinn Abbott'.split()
+CATEGORIES = ['Fiction', 'Non-Fiction', 'Science', 'History', 'Biography', 'Children']
+
+
+def _batched(rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == BATCH:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _insert(model, rows):
+    count = 0
+    for batch in _batched(rows):
+        db.session.execute(db.insert(model), batch)
+        count += len(batch)
+    db.session.commit()
+    return count
+
+
+def _next_id(model):
+    return (db.session.query(db.func.max(model.id)).scalar() or 0) + 1
+
+
+def _title(rng):
+    words = rng.sample(WORDS, rng.randint(2, 4))
+    return ' '.join(w.capitalize() for w in words)
+
+
+def seed(products=10000, users=500, orders=5000, carts=200, seed=0, log=print):
+    rng = random.Random(seed)
+    db.create_all()
+
+    for name in CATEGORIES:
+        if not Category.query.filter_by(name=name).first():
+            db.session.add(Category(name=name))
+    db.session.commit()
+    category_ids = [c.id for c in Category.query.all()]
+
+    first_product = _next_id(Product)
+    _insert(Product, ({
+        'title': f'{_title(rng)} {i}',
+        'author': f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}',
+        'description': ' '.join(rng.choices(WORDS, k=12)),
+        'price': round(rng.uniform(4, 60), 2),
+        'stock': rng.randint(0, 200),
+        'category_id': rng.choice(category_ids),
+        'image_url': None,
+    } for i in range(products)))
+    product_ids = range(first_product, first_product + products)
+    log(f'products: {products}')
+
+    # One shared hash; hashing per user would dominate the seeding time
+    password_hash = password_hasher.hash(PASSWORD)
+    first_user = _next_id(User)
+    tag = rng.getrandbits(32)
+    _insert(User, ({
+        'username': f'bench{tag:x}_{i}',
+        'email': f'bench{tag:x}_{i}@example.com',
+        'password_hash': password_hash,
+        'is_admin': False,
+    } for i in range(users)))
+    user_ids = range(first_user, first_user + users)
+    usernames = [f'bench{tag:x}_{i}' for i in range(users)]
+    log(f'users: {users}')
+
+    # Ids are assigned up front so order lines can reference their order
+    # without reading anything back
+    first_order = _next_id(Order)
+    now = datetime.utcnow()
+    order_rows = []
+    item_rows = []
+    for i in range(orders):
+        lines = rng.sample(product_ids, min(rng.randint(1, 4), len(product_ids)))
+        total = 0.0
+        for product_id in lines:
+            quantity = rng.randint(1, 3)
+            price = round(rng.uniform(4, 60), 2)
+            total += price * quantity
+            item_rows.append({'order_id': first_order + i, 'product_id': product_id,
+                              'quantity': quantity, 'price': price})
+        order_rows.append({'id': first_order + i, 'user_id': rng.choice(user_ids),
+                           'total': round(total, 2), 'status': 'completed',
+                           'created_at': now - timedelta(minutes=rng.randint(0, 60 * 24 * 90))})
+    if orders:
+        _insert(Order, order_rows)
+        _insert(OrderItem, item_rows)
+    log(f'orders: {orders} ({len(item_rows)} lines)')
+
+    cart_users = rng.sample(user_ids, min(carts, len(user_ids)))
+    _insert(CartItem, ({'user_id': user_id, 'product_id': product_id, 'quantity': rng.randint(1, 2)}
+                       for user_id in cart_users
+                       for product_id in rng.sample(product_ids, min(3, len(product_ids)))))
+    _insert(Wishlist, ({'user_id': user_id, 'product_id': product_id}
+                       for user_id in cart_users
+                       for product_id in rng.sample(product_ids, min(3, len(product_ids)))))
+    log(f'carts and wishlists: {len(cart_users)} users')
+
+    bestsellers.rebuild()
+    rollups.reconcile()
+    recommendations.rebuild()
+    return usernames
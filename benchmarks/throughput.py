@@ -0,0 +1,108 @@
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Concurrent read/write throughput of one configuration profile against a
+# file-backed SQLite database, to compare the default settings with
+# APP_ENV=production (WAL, busy_timeout, pool tuning):
+#
+#     python -m benchmarks.throughput --threads 16 --duration 10
+#
+# Each profile runs in its own subprocess since configuration is read when
+# the app is imported.
+
+PROFILES = ('default', 'production')
+
+
+def worker(args):
+    from app import app, init_db
+    from models import Product
+    from benchmarks import seed
+
+    app.config['PROPAGATE_EXCEPTIONS'] = False
+    init_db()
+    with app.app_context():
+        usernames = seed.seed(args.products, args.threads, 0, 0, log=lambda *a: None)
+        product_ids = [pid for pid, in Product.query.with_entities(Product.id).limit(2000)]
+        # Plenty of stock so failures are contention, not sold-out items
+        Product.query.update({Product.stock: 10 ** 6})
+        from models import db
+        db.session.commit()
+
+    counts = {'ok': 0, 'errors': 0, 'writes': 0}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + args.duration
+    barrier = threading.Barrier(args.threads)
+
+    def shopper(username, rng):
+        client = app.test_client()
+        client.post('/login', data={'username': username, 'password': seed.PASSWORD})
+        barrier.wait()
+        while time.perf_counter() < deadline:
+            if rng.random() < args.write_ratio:
+                requests = [('POST', f'/add_to_cart/{rng.choice(product_ids)}'), ('POST', '/checkout')]
+            else:
+                requests = [('GET', f'/product/{rng.choice(product_ids)}'), ('GET', '/products')]
+            for method, url in requests:
+                try:
+                    status = client.open(url, method=method).status_code
+                except Exception:
+                    status = 500
+                with lock:
+                    if status >= 500:
+                        counts['errors'] += 1
+                    else:
+                        counts['ok'] += 1
+                        counts['writes'] += method == 'POST'
+
+    threads = [threading.Thread(target=shopper, args=(username, random.Random(i)))
+               for i, username in enumerate(usernames)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    counts['requests_per_second'] = counts['ok'] / elapsed
+    print(json.dumps(counts))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.throughput')
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--products', type=int, default=5000)
+    parser.add_argument('--write-ratio', type=float, default=0.3)
+    parser.add_argument('--profile', choices=PROFILES, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.profile:
+        worker(args)
+        return
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    results = {}
+    for profile in PROFILES:
+        directory = tempfile.mkdtemp(prefix='bookstore-throughput-')
+        env = dict(os.environ, APP_ENV=profile, CACHE_BACKEND='none',
+                   DATABASE_URL='sqlite:///' + os.path.join(directory, 'bench.db'))
+        command = [sys.executable, '-m', 'benchmarks.throughput', '--profile', profile,
+                   '--threads', str(args.threads), '--duration', str(args.duration),
+                   '--products', str(args.products), '--write-ratio', str(args.write_ratio)]
+        output = subprocess.run(command, env=env, cwd=root, check=True,
+                                capture_output=True, text=True).stdout
+        results[profile] = json.loads(output.strip().splitlines()[-1])
+
+    print(f'{"profile":<12}{"req/s":>10}{"ok":>10}{"writes":>10}{"errors":>10}')
+    for profile, r in results.items():
+        print(f'{profile:<12}{r["requests_per_second"]:>10.1f}{r["ok"]:>10}{r["writes"]:>10}{r["errors"]:>10}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+from datetime import datetime, timedelta
+
+from database import increment_from
+from models import db, Product, Order, OrderItem, ProductSales, ProductSalesDaily
+
+# Best-seller rankings read from counters kept up to date at checkout, so the
+# home page never aggregates the order history.
+
+WINDOWS = {'7d': 7, '30d': 30, 'all': None}
+
+
+def record_sales(order_id, when=None):
+    # Call inside the checkout transaction once the order's lines are
+    # inserted; one statement per counter table whatever the order size
+    day = (when or datetime.utcnow()).date()
+    # Ordered so concurrent checkouts lock counter rows in the same order
+    lines = db.select(OrderItem.product_id, db.func.count().label('order_count'))\
+        .where(OrderItem.order_id == order_id)\
+        .group_by(OrderItem.product_id)\
+        .subquery()
+    increment_from(ProductSales, db.select(lines.c.product_id, lines.c.order_count)
+                   .order_by(lines.c.product_id), ['product_id'], ['order_count'])
+    increment_from(ProductSalesDaily, db.select(db.literal(day), lines.c.product_id, lines.c.order_count)
+                   .order_by(lines.c.product_id), ['day', 'product_id'], ['order_count'])
+
+
+def top_sellers(limit=8, window='all'):
+    days = WINDOWS[window]
+    if days is None:
+        rows = db.session.query(Product, ProductSales.order_count)\
+            .join(ProductSales, ProductSales.product_id == Product.id)\
+            .order_by(ProductSales.order_count.desc(), Product.id)\
+            .limit(limit).all()
+    else:
+        since = datetime.utcnow().date() - timedelta(days=days - 1)
+        sold = db.session.query(ProductSalesDaily.product_id,
+                                db.func.sum(ProductSalesDaily.order_count).label('order_count'))\
+            .filter(ProductSalesDaily.day >= since)\
+            .group_by(ProductSalesDaily.product_id)\
+            .subquery()
+        rows = db.session.query(Product, sold.c.order_count)\
+            .join(sold, sold.c.product_id == Product.id)\
+            .order_by(sold.c.order_count.desc(), Product.id)\
+            .limit(limit).all()
+
+    # Not enough sales yet: fill the remaining slots with unsold products
+    if len(rows) < limit:
+        seen = [product.id for product, _ in rows]
+        rows += [(p, 0) for p in Product.query.filter(~Product.id.in_(seen))
+                 .order_by(Product.id).limit(limit - len(rows)).all()]
+    return rows
+
+
+def rebuild():
+    # Recompute every counter from the order history; returns the number of
+    # products that have sold
+    db.session.execute(ProductSalesDaily.__table__.delete())
+    db.session.execute(ProductSales.__table__.delete())
+    db.session.execute(ProductSales.__table__.insert().from_select(
+        ['product_id', 'order_count'],
+        db.select(OrderItem.product_id, db.func.count(OrderItem.id))
+        .group_by(OrderItem.product_id)
+    ))
+    day = db.func.date(Order.created_at)
+    db.session.execute(ProductSalesDaily.__table__.insert().from_select(
+        ['day', 'product_id', 'order_count'],
+        db.select(day, OrderItem.product_id, db.func.count(OrderItem.id))
+        .join(Order, Order.id == OrderItem.order_id)
+        .group_by(day, OrderItem.product_id)
+    ))
+    db.session.commit()
+    return db.session.query(ProductSales).count()
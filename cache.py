@@ -0,0 +1,263 @@
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, request, session, render_template, make_response
+from flask_login import current_user
+from markupsafe import Markup
+from models import db, OrderItem
+
+# Response and fragment caching for catalog pages.
+#
+# Anonymous visitors get whole cached responses from cached_page(); logged-in
+# users still render the page but reuse cached fragments through the
+# fragment() template global. Entries expire after a TTL and backends evict
+# by total size. Admin product changes clear everything, checkout only the
+# entries for the products that were bought.
+
+
+def _weigh(value):
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    if isinstance(value, (tuple, list)):
+        return sum(_weigh(v) for v in value)
+    return 64
+
+
+class NullCache:
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+
+class LRUCache:
+    # Per-process; with several workers each keeps its own copy and only
+    # invalidations made in the same worker are seen before the TTL expires
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, value, weight = entry
+            if expires < time.time():
+                self._pop(key)
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        weight = _weigh(value)
+        if weight > self.max_bytes:
+            return
+        with self.lock:
+            self._pop(key)
+            self.entries[key] = (time.time() + ttl, value, weight)
+            self.size += weight
+            while self.size > self.max_bytes:
+                self._pop(next(iter(self.entries)))
+
+    def _pop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    def delete(self, key):
+        with self.lock:
+            self._pop(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+class FileSystemCache:
+    # Shared by every worker on the host: one file per entry, written
+    # atomically, pruned oldest-first once the directory exceeds max_bytes
+
+    prune_every = 100
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.writes = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest())
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                expires, value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if expires < time.time():
+            self._remove(path)
+            return None
+        return value
+
+    def set(self, key, value, ttl):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((time.time() + ttl, value), f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self._path(key))
+        except OSError:
+            self._remove(tmp)
+            return
+        self.writes += 1
+        if self.writes % self.prune_every == 0:
+            self.prune()
+
+    def prune(self):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith('.tmp'):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def delete(self, key):
+        self._remove(self._path(key))
+
+    def clear(self):
+        for entry in os.scandir(self.directory):
+            self._remove(entry.path)
+
+
+class CatalogCache:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('CACHE_BACKEND', 'lru')
+        app.config.setdefault('CACHE_DIR', os.path.join(app.instance_path, 'cache'))
+        app.config.setdefault('CACHE_MAX_BYTES', 64 * 1024 * 1024)
+        app.config.setdefault('CACHE_DEFAULT_TTL', 60)
+
+        backend = app.config['CACHE_BACKEND']
+        if backend == 'filesystem':
+            store = FileSystemCache(app.config['CACHE_DIR'], app.config['CACHE_MAX_BYTES'])
+        elif backend == 'lru':
+            store = LRUCache(app.config['CACHE_MAX_BYTES'])
+        else:
+            store = NullCache()
+        app.extensions['catalog_cache'] = store
+        app.jinja_env.globals['fragment'] = self.fragment
+
+    @property
+    def store(self):
+        return current_app.extensions['catalog_cache']
+
+    def _ttl(self, ttl):
+        return ttl or current_app.config['CACHE_DEFAULT_TTL']
+
+    @staticmethod
+    def page_key(endpoint, view_args, args):
+        view = ','.join(f'{k}={v}' for k, v in sorted(view_args.items()))
+        query = '&'.join(f'{k}={v}' for k, v in sorted(args))
+        return f'page:{endpoint}:{view}?{query}'
+
+    def cached_page(self, ttl=None):
+        # Whole-response cache for anonymous GETs, keyed on the endpoint,
+        # its URL arguments and the query string
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                if (request.method != 'GET' or current_user.is_authenticated
+                        or '_flashes' in session):
+                    return view(*args, **kwargs)
+                key = self.page_key(request.endpoint, request.view_args or {},
+                                    request.args.items(multi=True))
+                cached = self.store.get(key)
+                if cached is not None:
+                    body, status, mimetype = cached
+                    response = current_app.response_class(body, status=status, mimetype=mimetype)
+                    response.headers['X-Cache'] = 'HIT'
+                    return response
+                response = make_response(view(*args, **kwargs))
+                if response.status_code == 200 and not response.direct_passthrough:
+                    self.store.set(key, (response.get_data(), response.status_code, response.mimetype),
+                                   self._ttl(ttl))
+                response.headers['X-Cache'] = 'MISS'
+                return response
+            return wrapper
+        return decorator
+
+    def fragment(self, template, key, ttl=None, **context):
+        # Rendered template fragment. Callable context values are only
+        # called on a miss, so their queries are skipped on a hit.
+        key = f'fragment:{key}:{int(current_user.is_authenticated)}'
+        html = self.store.get(key)
+        if html is None:
+            context = {k: v() if callable(v) else v for k, v in context.items()}
+            html = render_template(template, **context)
+            self.store.set(key, html, self._ttl(ttl))
+        return Markup(html)
+
+    def memoize(self, key, compute, ttl=None):
+        # Cached result of compute(), for data shared by several pages
+        value = self.store.get(key)
+        if value is None:
+            value = compute()
+            self.store.set(key, value, self._ttl(ttl))
+        return value
+
+    def invalidate_products(self, product_ids):
+        for product_id in product_ids:
+            for authenticated in (0, 1):
+                self.store.delete(f'fragment:product_card:{product_id}:{authenticated}')
+            self.store.delete(self.page_key('product_detail', {'id': product_id}, ()))
+
+    def invalidate_order(self, order_id):
+        self.invalidate_products(
+            pid for pid, in db.session.query(OrderItem.product_id).filter_by(order_id=order_id))
+        # In-stock counts of the unfiltered category facets; facets for
+        # searches catch up when they expire
+        self.store.delete('facets:')
+
+    def clear(self):
+        self.store.clear()
+
+
+catalog_cache = CatalogCache()
@@ -0,0 +1,61 @@
+from models import db, Product
+from pagination import paginate
+from search import product_search
+
+# The product listing shared by the HTML pages, the infinite-scroll feed and
+# the JSON API: category, price-range and in-stock filters, search and one of
+# the sort orders, one keyset page at a time. Raises
+# pagination.InvalidCursor for a bad cursor.
+
+
+def catalog_page(args, per_page):
+    category_id = args.get('category', type=int)
+    min_price = args.get('min_price', type=float)
+    max_price = args.get('max_price', type=float)
+    in_stock = args.get('in_stock') in ('1', 'true', 'on')
+    search_term = args.get('search', '')
+    sort = args.get('sort') or ('relevance' if search_term else 'name_asc')
+    
+    query = Product.query
+    if category_id:
+        query = query.filter_by(category_id=category_id)
+    if min_price is not None:
+        query = query.filter(Product.price >= min_price)
+    if max_price is not None:
+        query = query.filter(Product.price <= max_price)
+    if in_stock:
+        query = query.filter(Product.stock > 0)
+    matches = None
+    if search_term:
+        # Joined rather than cut to a top-N list, so the filters, sorts and
+        # pages above see every match
+        matches = product_search.matches(search_term)
+        if matches is None:
+            query = query.filter(db.false())
+        else:
+            query = query.join(matches, matches.c.product_id == Product.id)
+    
+    # Sort keys, each ending in Product.id so keyset cursors are unambiguous
+    ranked = sort == 'relevance' and matches is not None
+    if ranked:
+        # Rows are (Product, score) until the page is fetched
+        query = query.add_columns(matches.c.score)
+        keys = [(matches.c.score, True), (Product.id, True)]
+        key_values = lambda row: (row.score, row[0].id)
+    elif sort == 'price_asc':
+        keys = [(Product.price, True), (Product.id, True)]
+        key_values = lambda p: (p.price, p.id)
+    elif sort == 'price_desc':
+        keys = [(Product.price, False), (Product.id, False)]
+        key_values = lambda p: (p.price, p.id)
+    elif sort == 'name_desc':
+        keys = [(Product.title, False), (Product.id, False)]
+        key_values = lambda p: (p.title, p.id)
+    else:  # name_asc
+        keys = [(Product.title, True), (Product.id, True)]
+        key_values = lambda p: (p.title, p.id)
+    
+    page = paginate(query, keys, per_page, args.get('cursor'), key_values)
+    if ranked:
+        page.items = [row[0] for row in page.items]
+    return page
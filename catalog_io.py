@@ -0,0 +1,280 @@
+import csv
+import io
+import json
+import math
+import os
+import uuid
+from datetime import datetime
+
+from flask import current_app
+from models import db, Product, Category, ProductImport
+from search import product_search
+from cache import catalog_cache
+from jobs import handler, job_queue
+import rollups
+
+# Streaming catalog import and export.
+#
+# Imports read CSV or JSON Lines one row at a time, validate each row against
+# the Product columns, and upsert in batches: one lookup query, one
+# executemany UPDATE and one executemany INSERT per batch, each batch in its
+# own transaction. A row updates an existing product when it carries that
+# product's id, or otherwise when a product with the same title and author
+# exists. Invalid rows are reported with their line number and skipped.
+#
+# Files uploaded on the admin page are saved under IMPORT_DIR and imported by
+# a 'product_import' job, so a large feed never runs inside a web request.
+
+FIELDS = ['id', 'title', 'author', 'description', 'price', 'stock', 'category', 'image_url']
+MAX_REPORTED_ERRORS = 1000
+
+
+class ImportReport:
+    def __init__(self):
+        self.rows = 0
+        self.inserted = 0
+        self.updated = 0
+        self.error_count = 0
+        self.errors = []
+
+    def error(self, line, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((line, message))
+
+
+def _lengths():
+    columns = Product.__table__.c
+    return {name: columns[name].type.length for name in ('title', 'author', 'image_url')}
+
+
+def _text(row, name, lengths, required=False):
+    value = row.get(name)
+    value = '' if value is None else str(value).strip()
+    if required and not value:
+        raise ValueError(f'{name} is required')
+    limit = lengths.get(name)
+    if limit and len(value) > limit:
+        raise ValueError(f'{name} is longer than {limit} characters')
+    return value or None
+
+
+def _number(row, name, cast, default=None):
+    value = row.get(name)
+    if value is None or value == '':
+        if default is None:
+            raise ValueError(f'{name} is required')
+        return default
+    # JSON true/false would otherwise pass as 1 and 0
+    if isinstance(value, bool):
+        raise ValueError(f'{name} must be a number')
+    try:
+        number = cast(value)
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError(f'{name} must be a number')
+    if not math.isfinite(number):
+        raise ValueError(f'{name} must be a finite number')
+    if number < 0:
+        raise ValueError(f'{name} must not be negative')
+    return number
+
+
+def validate(row, categories, lengths):
+    # Returns column values for Product, raising ValueError on bad input
+    values = {
+        'title': _text(row, 'title', lengths, required=True),
+        'author': _text(row, 'author', lengths, required=True),
+        'description': _text(row, 'description', lengths),
+        'price': _number(row, 'price', float),
+        'stock': _number(row, 'stock', int, default=0),
+        'image_url': _text(row, 'image_url', lengths),
+    }
+    category = row.get('category') or row.get('category_id')
+    if category in (None, ''):
+        raise ValueError('category is required')
+    category = str(category).strip()
+    if category.isdigit() and int(category) in categories.values():
+        values['category_id'] = int(category)
+    elif category.lower() in categories:
+        values['category_id'] = categories[category.lower()]
+    else:
+        raise ValueError(f'unknown category {category!r}')
+    if row.get('id') not in (None, ''):
+        values['id'] = _number(row, 'id', int)
+    return values
+
+
+def read_rows(stream, fmt):
+    # Yields (line number, dict) from a text stream
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+    elif fmt == 'jsonl':
+        for line_number, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                row = e
+            yield line_number, row
+    else:
+        raise ValueError(f'unsupported format {fmt!r}')
+
+
+def _flush(batch, report):
+    # batch maps a match key to (line, values); later rows win within a batch
+    ids = [v['id'] for _, v in batch.values() if 'id' in v]
+    pairs = [(v['title'], v['author']) for _, v in batch.values() if 'id' not in v]
+    existing_ids = set()
+    if ids:
+        existing_ids = {pid for pid, in db.session.query(Product.id).filter(Product.id.in_(ids))}
+    by_name = {}
+    if pairs:
+        by_name = {(t, a): pid for pid, t, a in db.session.query(Product.id, Product.title, Product.author)
+                   .filter(db.tuple_(Product.title, Product.author).in_(pairs))}
+
+    updates = []
+    inserts = []
+    for line, values in batch.values():
+        if 'id' in values:
+            if values['id'] in existing_ids:
+                updates.append(values)
+            else:
+                report.error(line, f'no product with id {values["id"]}')
+        elif (values['title'], values['author']) in by_name:
+            updates.append(dict(values, id=by_name[(values['title'], values['author'])]))
+        else:
+            inserts.append(values)
+
+    if updates:
+        db.session.execute(db.update(Product), updates)
+    if inserts:
+        db.session.execute(db.insert(Product), inserts)
+        rollups.add(products=len(inserts))
+    db.session.commit()
+    report.updated += len(updates)
+    report.inserted += len(inserts)
+    return [values['id'] for values in updates]
+
+
+def import_products(stream, fmt='csv', batch_size=1000, create_categories=False, progress=None):
+    report = ImportReport()
+    # Products added from here on are new to the search index
+    last_id = db.session.query(db.func.max(Product.id)).scalar() or 0
+    updated_ids = []
+    categories = {c.name.lower(): c.id for c in Category.query.all()}
+    lengths = _lengths()
+    batch = {}
+
+    for line, row in read_rows(stream, fmt):
+        report.rows += 1
+        if not isinstance(row, dict):
+            report.error(line, 'not a JSON object' if not isinstance(row, Exception) else f'invalid JSON: {row}')
+            continue
+        name = str(row.get('category') or '').strip()
+        if create_categories and name and not name.isdigit() and name.lower() not in categories:
+            category = Category(name=name)
+            db.session.add(category)
+            db.session.commit()
+            categories[name.lower()] = category.id
+        try:
+            values = validate(row, categories, lengths)
+        except ValueError as e:
+            report.error(line, str(e))
+            continue
+        key = ('id', values['id']) if 'id' in values else ('name', values['title'], values['author'])
+        batch[key] = (line, values)
+        if len(batch) >= batch_size:
+            updated_ids += _flush(batch, report)
+            batch = {}
+            if progress:
+                progress(report)
+
+    if batch:
+        updated_ids += _flush(batch, report)
+    if progress:
+        progress(report)
+
+    if report.inserted or report.updated:
+        added_ids = [pid for pid, in db.session.query(Product.id).filter(Product.id > last_id)]
+        product_search.products_changed(updated_ids + added_ids)
+        catalog_cache.clear()
+    return report
+
+
+def _upload_path(upload_name):
+    directory = current_app.config.get('IMPORT_DIR') or os.path.join(current_app.instance_path, 'imports')
+    return os.path.join(directory, upload_name)
+
+
+def import_job_key(import_id):
+    return f'product_import:{import_id}'
+
+
+def start_import(upload, fmt, create_categories=False):
+    # Saves the upload before opening a transaction, then records it and
+    # enqueues its job together
+    upload_name = uuid.uuid4().hex
+    path = _upload_path(upload_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    upload.save(path)
+    record = ProductImport(filename=upload.filename[:255], upload_name=upload_name, format=fmt,
+                           create_categories=create_categories)
+    db.session.add(record)
+    db.session.flush()
+    job_queue.enqueue('product_import', {'import_id': record.id}, key=import_job_key(record.id))
+    db.session.commit()
+    return record
+
+
+@handler('product_import')
+def run_import(import_id):
+    # Unlike other handlers this commits, once per batch, and renews its
+    # job's lease as it goes. A retry imports the whole file again, which the
+    # upsert makes safe.
+    record = db.session.get(ProductImport, import_id)
+    if record is None or record.finished_at is not None:
+        return
+
+    def progress(report):
+        record.rows, record.inserted, record.updated = report.rows, report.inserted, report.updated
+        record.error_count = report.error_count
+        job_queue.renew(import_job_key(import_id))
+        db.session.commit()
+
+    path = _upload_path(record.upload_name)
+    with open(path, encoding='utf-8-sig', newline='') as stream:
+        report = import_products(stream, record.format, create_categories=record.create_categories,
+                                 progress=progress)
+    record.errors = json.dumps(report.errors)
+    record.finished_at = datetime.utcnow()
+    db.session.commit()
+    os.remove(path)
+
+
+def export_rows(fmt='csv', batch_size=1000):
+    # Yields the catalog as chunks of text, holding one batch of rows at a time
+    query = db.session.query(Product.id, Product.title, Product.author, Product.description,
+                             Product.price, Product.stock, Category.name, Product.image_url)\
+        .join(Category, Category.id == Product.category_id)\
+        .order_by(Product.id)\
+        .execution_options(yield_per=batch_size)
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if fmt == 'csv' else None
+    if writer:
+        writer.writerow(FIELDS)
+    count = 0
+    for row in query:
+        if writer:
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps(dict(zip(FIELDS, row)), separators=(',', ':')) + '\n')
+        count += 1
+        if count % batch_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
@@ -4,3 +4,109 @@ class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'dev-secret-key-change-in-production'
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///bookstore.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # 'auto' uses SQLite FTS5 when available, otherwise the in-process index,
+    # which each worker keeps current from the search_change log
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND') or 'auto'
+    SEARCH_MAX_RESULTS = int(os.environ.get('SEARCH_MAX_RESULTS') or 500)
+    PRODUCTS_PER_PAGE = int(os.environ.get('PRODUCTS_PER_PAGE') or 24)
+    ADMIN_PRODUCTS_PER_PAGE = int(os.environ.get('ADMIN_PRODUCTS_PER_PAGE') or 50)
+    # Best-seller ranking on the home page: '7d', '30d' or 'all'
+    BESTSELLER_WINDOW = os.environ.get('BESTSELLER_WINDOW') or 'all'
+    # How long a cart line holds its stock before other shoppers can buy it
+    CART_HOLD_SECONDS = int(os.environ.get('CART_HOLD_SECONDS') or 900)
+    # Neighbors stored per product and kind, and shown on the product page
+    RECOMMENDATIONS_KEEP = int(os.environ.get('RECOMMENDATIONS_KEEP') or 20)
+    RECOMMENDATIONS_SHOWN = int(os.environ.get('RECOMMENDATIONS_SHOWN') or 4)
+    # Customers with more distinct products are skipped when pairing
+    RECOMMENDATIONS_MAX_BASKET = int(os.environ.get('RECOMMENDATIONS_MAX_BASKET') or 500)
+    DASHBOARD_TREND_DAYS = int(os.environ.get('DASHBOARD_TREND_DAYS') or 14)
+    # Werkzeug method for new and upgraded password hashes, e.g.
+    # 'scrypt:32768:8:1' or 'pbkdf2:sha256:600000'
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or 'scrypt'
+    # Hashes running at once per process, and running or waiting before
+    # logins get a 503
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS') or os.cpu_count() or 2)
+    PASSWORD_HASH_QUEUE = int(os.environ.get('PASSWORD_HASH_QUEUE') or 64)
+    # Failed logins allowed per username and per client address in the window
+    LOGIN_MAX_FAILURES = int(os.environ.get('LOGIN_MAX_FAILURES') or 5)
+    LOGIN_MAX_FAILURES_PER_IP = int(os.environ.get('LOGIN_MAX_FAILURES_PER_IP') or 50)
+    LOGIN_FAILURE_WINDOW = int(os.environ.get('LOGIN_FAILURE_WINDOW') or 300)
+    # Session storage: 'sql' (server_session table), 'filesystem' or 'cookie'
+    SESSION_BACKEND = os.environ.get('SESSION_BACKEND') or 'sql'
+    # The sql backend uses the main database unless SESSION_DATABASE_URL is set
+    if os.environ.get('SESSION_DATABASE_URL'):
+        SQLALCHEMY_BINDS = {'sessions': os.environ['SESSION_DATABASE_URL']}
+    if os.environ.get('SESSION_FILE_DIR'):
+        SESSION_FILE_DIR = os.environ['SESSION_FILE_DIR']
+    # Seconds a worker trusts its cached copy of a user's identity fields
+    USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL') or 60)
+    # Background jobs also run on a thread in each web process; turn off
+    # when a `flask run-jobs` worker is deployed
+    JOBS_IN_PROCESS = os.environ.get('JOBS_IN_PROCESS', 'true').lower() in ('1', 'true', 'yes')
+    JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS') or 8)
+    # Catalog uploads wait here for their import job, so it must be shared
+    # with the job worker (default: instance/imports)
+    if os.environ.get('IMPORT_DIR'):
+        IMPORT_DIR = os.environ['IMPORT_DIR']
+    # Outgoing mail; with no MAIL_SERVER messages are only logged
+    MAIL_SERVER = os.environ.get('MAIL_SERVER')
+    MAIL_PORT = int(os.environ.get('MAIL_PORT') or 587)
+    MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS', 'true').lower() in ('1', 'true', 'yes')
+    MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
+    MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
+    MAIL_SENDER = os.environ.get('MAIL_SENDER') or 'Bookstore <noreply@bookstore.com>'
+    # Where contact form messages are sent
+    CONTACT_EMAIL = os.environ.get('CONTACT_EMAIL') or 'admin@bookstore.com'
+    # Catalog page/fragment cache: 'lru' (per worker), 'filesystem' (shared
+    # between workers on one host) or 'none'
+    CACHE_BACKEND = os.environ.get('CACHE_BACKEND') or 'lru'
+    CACHE_DEFAULT_TTL = int(os.environ.get('CACHE_DEFAULT_TTL') or 60)
+    CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES') or 64 * 1024 * 1024)
+    if os.environ.get('CACHE_DIR'):
+        CACHE_DIR = os.environ['CACHE_DIR']
+    # Per-route timing and SQL instrumentation, see metrics.py
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '').lower() in ('1', 'true', 'yes')
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE') or 0)
+    PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP') or 10)
+    # Applied to every new SQLite connection, see database.py
+    SQLITE_PRAGMAS = {'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT') or 5000)}
+
+def _engine_options(uri, prefix='DB_', pool_size=5, max_overflow=10):
+    options = {
+        'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes'),
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE') or 1800),
+    }
+    # In-memory SQLite uses a single shared connection with no pool to size
+    if not (uri.startswith('sqlite') and ':memory:' in uri or uri == 'sqlite://'):
+        options.update(
+            pool_size=int(os.environ.get(prefix + 'POOL_SIZE') or pool_size),
+            max_overflow=int(os.environ.get(prefix + 'MAX_OVERFLOW') or max_overflow),
+            pool_timeout=int(os.environ.get('DB_POOL_TIMEOUT') or 30),
+        )
+    return options
+
+# Selected with APP_ENV=production (gunicorn.conf.py sets it by default).
+# Pool sizes are per worker process, and the sessions bind has a pool of its
+# own: keep workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW + SESSION_DB_POOL_SIZE +
+# SESSION_DB_MAX_OVERFLOW) under the database's connection limit.
+class ProductionConfig(Config):
+    SQLALCHEMY_ENGINE_OPTIONS = _engine_options(Config.SQLALCHEMY_DATABASE_URI)
+    # SQLALCHEMY_ENGINE_OPTIONS only applies to the main engine. A request
+    # holds a sessions connection just long enough to load or save one row
+    _session_uri = os.environ.get('SESSION_DATABASE_URL') or Config.SQLALCHEMY_DATABASE_URI
+    SQLALCHEMY_BINDS = {'sessions': {'url': _session_uri, **_engine_options(_session_uri, 'SESSION_DB_', 2, 2)}}
+    # The Procfile runs a job worker
+    JOBS_IN_PROCESS = os.environ.get('JOBS_IN_PROCESS', 'false').lower() in ('1', 'true', 'yes')
+    # WAL lets readers proceed while a writer commits; NORMAL sync is safe
+    # with WAL and avoids an fsync per transaction
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT') or 5000),
+    }
+
+configs = {
+    'default': Config,
+    'production': ProductionConfig,
+}
@@ -0,0 +1,43 @@
+import time
+
+from flask import g, session
+from werkzeug.local import LocalProxy
+from models import db, CartItem, Wishlist
+
+# Navbar cart/wishlist badge counts, cached in the user's session so ordinary
+# page views don't query for them. Routes that change the cart or wishlist
+# call invalidate(); the TTL bounds staleness from other devices.
+
+SESSION_KEY = 'nav_counts'
+TTL = 300
+
+
+def _load(user_id):
+    cached = session.get(SESSION_KEY)
+    if cached and cached['uid'] == user_id and time.time() - cached['at'] < TTL:
+        return cached
+    # Both counts in one round trip
+    cart, wishlist = db.session.execute(db.select(
+        db.select(db.func.count()).where(CartItem.user_id == user_id).scalar_subquery(),
+        db.select(db.func.count()).where(Wishlist.user_id == user_id).scalar_subquery(),
+    )).one()
+    cached = {'uid': user_id, 'at': time.time(), 'cart': cart, 'wishlist': wishlist}
+    session[SESSION_KEY] = cached
+    return cached
+
+
+def nav_counts(user_id):
+    # Memoized per request; nothing is loaded until a template reads a count
+    def get(name):
+        if 'nav_counts' not in g:
+            g.nav_counts = _load(user_id)
+        return g.nav_counts[name]
+    return {
+        'cart_count': LocalProxy(lambda: get('cart')),
+        'wishlist_count': LocalProxy(lambda: get('wishlist')),
+    }
+
+
+def invalidate():
+    session.pop(SESSION_KEY, None)
+    g.pop('nav_counts', None)
@@ -0,0 +1,201 @@
+import hashlib
+import io
+import os
+import tempfile
+import time
+import urllib.request
+from urllib.parse import urlparse
+
+from flask import current_app, url_for
+from jobs import handler, job_queue
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Local cover images. The first request for a cover redirects to
+# Product.image_url and queues a job that fetches the original, which is
+# then stored content-addressed on disk
+# (COVER_DIR/<sha256 prefix>/<sha256>/original) next to JPEG thumbnails in
+# each of COVER_WIDTHS, generated on first use. URLs carry a hash of the
+# source URL, so they change when a product's image_url does and can be
+# cached by browsers forever. Thumbnails need Pillow; without it the
+# original is served at every width. A failed fetch isn't retried for
+# COVER_RETRY_AFTER seconds; the route keeps redirecting to the source until
+# a fetch succeeds.
+
+PLACEHOLDER = 'https://via.placeholder.com/300x400?text=Book+Cover'
+COVER_MAX_AGE = 365 * 24 * 3600
+FAILED = 'failed'
+
+
+class CoverError(Exception):
+    pass
+
+
+def _write(path, data):
+    # Atomic, so concurrent workers never see half a file
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except OSError:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def sniff(head):
+    # Image type from the first bytes of a file, or None
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if head.startswith(b'\x89PNG'):
+        return 'image/png'
+    if head.startswith(b'GIF8'):
+        return 'image/gif'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    return None
+
+
+def source_version(url):
+    return hashlib.sha1(url.encode()).hexdigest()[:12]
+
+
+class CoverImages:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('COVER_DIR', os.path.join(app.instance_path, 'covers'))
+        app.config.setdefault('COVER_WIDTHS', (50, 100, 200, 300, 400, 600, 800))
+        app.config.setdefault('COVER_FETCH_TIMEOUT', 10)
+        app.config.setdefault('COVER_MAX_BYTES', 10 * 1024 * 1024)
+        app.config.setdefault('COVER_QUALITY', 82)
+        app.config.setdefault('COVER_RETRY_AFTER', 3600)
+        app.jinja_env.globals['cover_url'] = self.url
+        app.jinja_env.globals['cover_srcset'] = self.srcset
+
+    @property
+    def directory(self):
+        return current_app.config['COVER_DIR']
+
+    # Template helpers
+
+    def url(self, product, width):
+        if not product.image_url:
+            return PLACEHOLDER
+        return url_for('cover', product_id=product.id, width=width, v=source_version(product.image_url))
+
+    def srcset(self, product, widths):
+        if not product.image_url:
+            return ''
+        return ', '.join(f'{self.url(product, width)} {width}w' for width in widths)
+
+    # Storage
+
+    def _source_path(self, url):
+        return os.path.join(self.directory, 'sources', hashlib.sha1(url.encode()).hexdigest())
+
+    def _image_dir(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def _read_source(self, url):
+        # (content hash or FAILED, modification time), or (None, 0)
+        try:
+            with open(self._source_path(url)) as f:
+                return f.read().strip() or None, os.fstat(f.fileno()).st_mtime
+        except OSError:
+            return None, 0
+
+    def digest_for(self, url):
+        # Content hash of the image behind url, or None if not stored yet
+        digest, _ = self._read_source(url)
+        return digest if digest != FAILED else None
+
+    def store(self, url, data):
+        # Accepts the original image for url; returns its content hash
+        if sniff(data[:12]) is None:
+            raise CoverError(f'{url} is not an image')
+        if Image is not None:
+            try:
+                with Image.open(io.BytesIO(data)) as image:
+                    image.verify()
+            except Exception:
+                raise CoverError(f'{url} is not a readable image')
+        digest = hashlib.sha256(data).hexdigest()
+        original = os.path.join(self._image_dir(digest), 'original')
+        if not os.path.exists(original):
+            _write(original, data)
+        _write(self._source_path(url), digest.encode())
+        return digest
+
+    def fetch(self, url):
+        if urlparse(url).scheme not in ('http', 'https'):
+            raise CoverError(f'unsupported image URL {url!r}')
+        limit = current_app.config['COVER_MAX_BYTES']
+        request = urllib.request.Request(url, headers={'User-Agent': 'bookstore-covers'})
+        try:
+            with urllib.request.urlopen(request, timeout=current_app.config['COVER_FETCH_TIMEOUT']) as response:
+                data = response.read(limit + 1)
+        except OSError as e:
+            raise CoverError(f'fetching {url} failed: {e}')
+        if len(data) > limit:
+            raise CoverError(f'{url} is larger than {limit} bytes')
+        return self.store(url, data)
+
+    def thumbnail(self, digest, width):
+        # Returns (path, mimetype) of the image at width, resizing on first use
+        directory = self._image_dir(digest)
+        original = os.path.join(directory, 'original')
+        if Image is None:
+            with open(original, 'rb') as f:
+                return original, sniff(f.read(12))
+        path = os.path.join(directory, f'{width}.jpg')
+        if not os.path.exists(path):
+            with Image.open(original) as image:
+                image.thumbnail((width, width * 4), Image.LANCZOS)
+                if image.mode not in ('RGB', 'L'):
+                    image = image.convert('RGB')
+                buffer = io.BytesIO()
+                image.save(buffer, 'JPEG', quality=current_app.config['COVER_QUALITY'],
+                           optimize=True, progressive=True)
+            _write(path, buffer.getvalue())
+        return path, 'image/jpeg'
+
+    def mark_failed(self, url):
+        _write(self._source_path(url), FAILED.encode())
+
+    def resolve(self, url, width):
+        # (path, mimetype) for url at width, or None if the original isn't
+        # stored yet. A fetch job is then added to the caller's transaction,
+        # keyed by the last failure so it is queued once per retry.
+        digest, mtime = self._read_source(url)
+        if digest is None or digest == FAILED:
+            if digest is None or time.time() - mtime >= current_app.config['COVER_RETRY_AFTER']:
+                job_queue.enqueue('fetch_cover', {'url': url},
+                                  key=f'fetch_cover:{hashlib.sha1(url.encode()).hexdigest()}:{int(mtime)}')
+            return None
+        return self.thumbnail(digest, width)
+
+
+cover_images = CoverImages()
+
+
+@handler('fetch_cover')
+def fetch_cover(url):
+    # A failed fetch is only logged: resolve() queues another one once
+    # COVER_RETRY_AFTER has passed
+    if cover_images.digest_for(url):
+        return
+    try:
+        cover_images.fetch(url)
+    except CoverError as e:
+        current_app.logger.warning('cover fetch failed: %s', e)
+        cover_images.mark_failed(url)
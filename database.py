@@ -0,0 +1,81 @@
+import sqlite3
+
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine
+from models import db
+
+# Per-connection SQLite settings. journal_mode=WAL is persistent in the
+# database file, the others only last for the connection, so all of them are
+# applied whenever the pool opens a new connection.
+
+
+def init_app(app):
+    pragmas = app.config.get('SQLITE_PRAGMAS') or {}
+
+    @event.listens_for(Engine, 'connect')
+    def apply_sqlite_pragmas(dbapi_connection, connection_record):
+        if not isinstance(dbapi_connection, sqlite3.Connection):
+            return
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+        cursor.close()
+
+
+def increment(model, keys, **amounts):
+    # Atomically add amounts to the counter columns of the row identified by
+    # keys, creating the row if it doesn't exist yet. Runs in the caller's
+    # transaction.
+    table = model.__table__
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        insert = (sqlite.insert if dialect == 'sqlite' else postgresql.insert)(table).values(**keys, **amounts)
+        db.session.execute(insert.on_conflict_do_update(
+            index_elements=list(keys),
+            set_={name: table.c[name] + insert.excluded[name] for name in amounts},
+        ))
+        return
+    where = [table.c[k] == v for k, v in keys.items()]
+    updated = db.session.execute(table.update().where(*where).values(
+        **{name: table.c[name] + amount for name, amount in amounts.items()}))
+    if not updated.rowcount:
+        db.session.execute(table.insert().values(**keys, **amounts))
+
+
+def increment_from(model, select, keys, amounts):
+    # increment() for every row of select, whose columns are the keys
+    # followed by the amounts, in one INSERT ... SELECT where the dialect
+    # has upserts. Runs in the caller's transaction.
+    table = model.__table__
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        rows = select.subquery()
+        # SQLite needs a WHERE to parse ON CONFLICT after INSERT ... SELECT
+        source = db.select(*rows.c).where(db.true())
+        insert = (sqlite.insert if dialect == 'sqlite' else postgresql.insert)(table)\
+            .from_select(list(keys) + list(amounts), source)
+        db.session.execute(insert.on_conflict_do_update(
+            index_elements=list(keys),
+            set_={name: table.c[name] + insert.excluded[name] for name in amounts},
+        ))
+        return
+    for row in db.session.execute(select).all():
+        increment(model, dict(zip(keys, row)), **dict(zip(amounts, row[len(keys):])))
+
+
+def insert_ignore(model, **values):
+    # Insert a row unless it would violate a unique constraint; True if it
+    # was inserted. Runs in the caller's transaction.
+    table = model.__table__
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        insert = (sqlite.insert if dialect == 'sqlite' else postgresql.insert)(table).values(**values)
+        return db.session.execute(insert.on_conflict_do_nothing()).rowcount == 1
+    try:
+        with db.session.begin_nested():
+            db.session.execute(table.insert().values(**values))
+    except IntegrityError:
+        return False
+    return True
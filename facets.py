@@ -0,0 +1,34 @@
+from collections import namedtuple
+
+from models import db, Product, Category
+from search import product_search, tokenize
+from cache import catalog_cache
+
+# Per-category facets for the catalog sidebar and filters: product count,
+# price range and in-stock count for every category, either over the whole
+# catalog or over the products matching a search, computed by one grouped
+# query and cached with the catalog pages. Product writes clear the catalog
+# cache; checkout drops the unfiltered facets since stock changed.
+
+Facet = namedtuple('Facet', 'id name count min_price max_price in_stock')
+
+
+def _compute(search_term=''):
+    joined = Product.category_id == Category.id
+    if search_term:
+        matches = product_search.matches(search_term)
+        matched = db.false() if matches is None else Product.id.in_(db.select(matches.c.product_id))
+        joined = db.and_(joined, matched)
+    in_stock = db.func.coalesce(db.func.sum(db.case((Product.stock > 0, 1), else_=0)), 0)
+    rows = db.session.query(Category.id, Category.name, db.func.count(Product.id),
+                            db.func.min(Product.price), db.func.max(Product.price), in_stock)\
+        .outerjoin(Product, joined)\
+        .group_by(Category.id, Category.name)\
+        .order_by(Category.id)
+    return [Facet(*row) for row in rows]
+
+
+def category_facets(search_term=''):
+    terms = ' '.join(tokenize(search_term))
+    return catalog_cache.memoize(
+        f'facets:{terms}', lambda: _compute(terms))
@@ -0,0 +1,57 @@
+# Gunicorn settings for production; picked up automatically when gunicorn is
+# started from this directory (see Procfile). Every value can be overridden
+# from the environment.
+import multiprocessing
+import os
+
+# Load config.ProductionConfig (pool tuning, SQLite WAL) unless told otherwise
+os.environ.setdefault('APP_ENV', 'production')
+
+bind = '0.0.0.0:' + os.environ.get('PORT', '8000')
+
+# Worker processes. Each has its own connection pool and in-process caches.
+workers = int(os.environ.get('WEB_CONCURRENCY') or multiprocessing.cpu_count() * 2 + 1)
+
+# gthread workers serve several requests per process with threads, so a slow
+# request (password hashing, a long query) doesn't block the whole worker.
+# Keep threads <= DB_POOL_SIZE + DB_MAX_OVERFLOW so threads never wait on the pool.
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS') or 4)
+
+# Import the app once in the master and fork workers from it: faster
+# startup and shared memory pages. Connections must not cross the fork, see
+# post_fork below.
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'true').lower() in ('1', 'true', 'yes')
+
+timeout = int(os.environ.get('GUNICORN_TIMEOUT') or 30)
+graceful_timeout = 30
+keepalive = 5
+
+# Recycle workers periodically to bound memory growth from fragmentation
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS') or 2000)
+max_requests_jitter = 200
+
+accesslog = '-'
+
+
+def when_ready(server):
+    # Set search up in the master before any worker serves a request: the
+    # FTS5 table and triggers, or the in-memory index, which preloaded
+    # workers then inherit instead of each building their own
+    from app import app
+    from models import db
+    from search import product_search
+    with app.app_context():
+        db.create_all()
+        product_search.setup()
+        db.session.remove()
+
+
+def post_fork(server, worker):
+    # Drop any pooled connections inherited from the master; each worker
+    # opens its own on first use
+    from app import app
+    from models import db
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
@@ -0,0 +1,79 @@
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+from flask_login import UserMixin
+from sqlalchemy import event
+from models import db, User
+
+# What current_user is for logged-in requests: the identity fields of a User
+# (no password hash, no relationships), kept in a small per-worker cache so
+# an ordinary page view costs no user query. Entries expire after
+# USER_CACHE_TTL seconds; committed changes to a User drop its entry in the
+# worker that made them, and the TTL bounds staleness in the others.
+
+FIELDS = ('id', 'username', 'email', 'is_admin')
+
+
+class Identity(UserMixin):
+    __slots__ = FIELDS
+
+    def __init__(self, id, username, email, is_admin):
+        self.id = id
+        self.username = username
+        self.email = email
+        self.is_admin = bool(is_admin)
+
+
+class UserCache:
+    def __init__(self, app=None):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('USER_CACHE_TTL', 60)
+        app.config.setdefault('USER_CACHE_SIZE', 10000)
+        event.listen(User, 'after_update', self._changed)
+        event.listen(User, 'after_delete', self._changed)
+        event.listen(db.session, 'after_commit', self._committed)
+
+    def get(self, user_id):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is not None and entry[0] > now:
+                self.entries.move_to_end(user_id)
+                return entry[1]
+        row = db.session.query(*(getattr(User, f) for f in FIELDS)).filter(User.id == user_id).first()
+        if row is None:
+            return None
+        identity = Identity(*row)
+        self.put(identity)
+        return identity
+
+    def put(self, user):
+        identity = Identity(*(getattr(user, f) for f in FIELDS))
+        config = current_app.config
+        with self.lock:
+            self.entries[identity.id] = (time.monotonic() + config['USER_CACHE_TTL'], identity)
+            self.entries.move_to_end(identity.id)
+            while len(self.entries) > config['USER_CACHE_SIZE']:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self.entries.pop(user_id, None)
+
+    # Dropped after commit, so a concurrent reload can't cache the old row
+    def _changed(self, mapper, connection, target):
+        db.session.info.setdefault('changed_users', set()).add(target.id)
+
+    def _committed(self, session):
+        for user_id in session.info.pop('changed_users', ()):
+            self.invalidate(user_id)
+
+
+user_cache = UserCache()
@@ -0,0 +1,122 @@
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app
+from models import db, Product, StockReservation
+
+# Cart stock holds. Putting a product in the cart holds that many units for
+# CART_HOLD_SECONDS; the hold is refreshed whenever the line changes and
+# dropped at checkout or when the line is removed. Available-to-sell is
+# Product.stock minus other shoppers' unexpired holds, summed from the
+# (product_id, expires_at, quantity) index. Expired holds stop counting at
+# once; release_expired() only clears them out of the table.
+
+
+class NotAvailable(Exception):
+    def __init__(self, product_id, available):
+        super().__init__(f'only {available} available')
+        self.product_id = product_id
+        self.available = available
+
+
+def _live_holds(now, exclude_user=None):
+    conditions = [StockReservation.expires_at > now]
+    if exclude_user is not None:
+        conditions.append(StockReservation.user_id != exclude_user)
+    return conditions
+
+
+def held_by_others(user_id, now):
+    # Correlated subquery for statements on Product
+    return db.select(db.func.coalesce(db.func.sum(StockReservation.quantity), 0))\
+        .where(StockReservation.product_id == Product.id, *_live_holds(now, user_id))\
+        .scalar_subquery()
+
+
+def available(products, user_id=None, now=None):
+    # Available-to-sell for already loaded products, keyed by id. The
+    # user's own holds don't count against them.
+    now = now or datetime.utcnow()
+    ids = [p.id for p in products]
+    held = {}
+    if ids:
+        held = dict(db.session.query(StockReservation.product_id, db.func.sum(StockReservation.quantity))
+                    .filter(StockReservation.product_id.in_(ids), *_live_holds(now, user_id))
+                    .group_by(StockReservation.product_id))
+    return {p.id: max((p.stock or 0) - (held.get(p.id) or 0), 0) for p in products}
+
+
+def reserve(user_id, product_id, quantity, now=None):
+    # Sets the user's hold on a product to quantity units in the caller's
+    # transaction. Raises NotAvailable, after rolling back, if fewer units
+    # are free.
+    if quantity <= 0:
+        raise ValueError(f'hold quantity must be positive, not {quantity}')
+    now = now or datetime.utcnow()
+    # A no-op write takes the product's row lock (the database write lock
+    # on SQLite) first, so concurrent holds on one title are checked one at
+    # a time against committed holds
+    locked = db.session.execute(
+        db.update(Product).where(Product.id == product_id).values(stock=Product.stock)
+        .execution_options(synchronize_session=False)
+    )
+    free = db.session.query(Product.stock - held_by_others(user_id, now))\
+        .filter(Product.id == product_id).scalar() if locked.rowcount else 0
+    if (free or 0) < quantity:
+        db.session.rollback()
+        raise NotAvailable(product_id, max(free or 0, 0))
+
+    expires_at = now + timedelta(seconds=current_app.config['CART_HOLD_SECONDS'])
+    updated = db.session.execute(
+        db.update(StockReservation)
+        .where(StockReservation.user_id == user_id, StockReservation.product_id == product_id)
+        .values(quantity=quantity, expires_at=expires_at)
+        .execution_options(synchronize_session=False)
+    )
+    if not updated.rowcount:
+        db.session.execute(db.insert(StockReservation).values(
+            user_id=user_id, product_id=product_id, quantity=quantity, expires_at=expires_at))
+
+
+def release(user_id, product_ids):
+    # Drops the user's holds on these products in the caller's transaction
+    db.session.execute(
+        db.delete(StockReservation)
+        .where(StockReservation.user_id == user_id, StockReservation.product_id.in_(list(product_ids)))
+        .execution_options(synchronize_session=False)
+    )
+
+
+def release_expired(batch_size=1000, now=None):
+    # Deletes expired holds a batch at a time, committing after each batch
+    # so the sweep never holds the write lock for long. Returns the number
+    # of holds released.
+    now = now or datetime.utcnow()
+    released = 0
+    while True:
+        ids = [rid for rid, in db.session.query(StockReservation.id)
+               .filter(StockReservation.expires_at <= now)
+               .order_by(StockReservation.expires_at).limit(batch_size)]
+        if not ids:
+            break
+        # Re-checked so a hold refreshed since the SELECT survives
+        result = db.session.execute(
+            db.delete(StockReservation)
+            .where(StockReservation.id.in_(ids), StockReservation.expires_at <= now)
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+        released += result.rowcount
+        if len(ids) < batch_size:
+            break
+    return released
+
+
+def sweep(every, batch_size=1000, log=print):
+    # Runs release_expired forever, every seconds apart
+    while True:
+        released = release_expired(batch_size)
+        if released:
+            log(f'released {released} expired holds')
+        db.session.remove()
+        time.sleep(every)
@@ -0,0 +1,191 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import event
+from database import insert_ignore
+from models import db, Job
+
+# Background jobs kept in the job table. enqueue() adds a job inside the
+# caller's transaction, so it exists exactly when the write that needs it
+# committed. Workers claim due jobs with a conditional UPDATE, so two
+# workers never run the same job, and run each handler in one transaction
+# with marking the job done: database effects of a job happen once, while
+# anything outside the database (mail) may repeat if that commit fails.
+#
+# A failed job is retried after JOB_RETRY_DELAY seconds, doubling on every
+# attempt up to JOB_MAX_RETRY_DELAY, and gives up after JOB_MAX_ATTEMPTS.
+# A job whose worker died is picked up again once its JOB_LEASE_SECONDS
+# lease runs out.
+#
+# `flask run-jobs` is the worker process. With JOBS_IN_PROCESS each web
+# process also runs jobs on a background thread, started by its first
+# enqueue and woken by every commit that enqueues more.
+
+HANDLERS = {}
+
+
+def handler(kind):
+    # Registers fn to run jobs of kind; it is called with the job's payload
+    # as keyword arguments and must not commit
+    def register(fn):
+        HANDLERS[kind] = fn
+        return fn
+    return register
+
+
+class JobQueue:
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('JOBS_IN_PROCESS', True)
+        app.config.setdefault('JOB_MAX_ATTEMPTS', 8)
+        app.config.setdefault('JOB_RETRY_DELAY', 5)
+        app.config.setdefault('JOB_MAX_RETRY_DELAY', 3600)
+        app.config.setdefault('JOB_LEASE_SECONDS', 300)
+        app.config.setdefault('JOB_POLL_INTERVAL', 1.0)
+        app.extensions['jobs'] = {'thread': None, 'pid': None, 'wake': None}
+        event.listen(db.session, 'after_commit', self._committed)
+
+    def enqueue(self, kind, payload=None, key=None, delay=0):
+        # Adds a job to the caller's transaction; False if a job with the
+        # same key already exists
+        now = datetime.utcnow()
+        added = insert_ignore(Job, kind=kind, key=key, payload=json.dumps(payload or {}),
+                              status='queued', attempts=0, run_at=now + timedelta(seconds=delay),
+                              created_at=now)
+        if added:
+            db.session.info['jobs_enqueued'] = True
+        return added
+
+    def renew(self, key):
+        # Extends the lease of the running job with this key, in the caller's
+        # transaction, for handlers that can run longer than JOB_LEASE_SECONDS
+        locked_until = datetime.utcnow() + timedelta(seconds=current_app.config['JOB_LEASE_SECONDS'])
+        db.session.execute(db.update(Job).where(Job.key == key, Job.status == 'running')
+                           .values(locked_until=locked_until))
+
+    # Running jobs
+
+    def _due(self, now):
+        return db.or_(db.and_(Job.status == 'queued', Job.run_at <= now),
+                      db.and_(Job.status == 'running', Job.locked_until <= now))
+
+    def claim(self):
+        # The next due job, leased to this worker; None if nothing is due
+        while True:
+            now = datetime.utcnow()
+            job_id = db.session.query(Job.id).filter(self._due(now))\
+                .order_by(Job.run_at, Job.id).limit(1).scalar()
+            if job_id is None:
+                db.session.rollback()
+                return None
+            claimed = db.session.execute(
+                db.update(Job)
+                .where(Job.id == job_id, self._due(now))
+                .values(status='running', attempts=Job.attempts + 1,
+                        locked_until=now + timedelta(seconds=current_app.config['JOB_LEASE_SECONDS']))
+                .execution_options(synchronize_session=False)
+            )
+            db.session.commit()
+            if claimed.rowcount == 1:
+                return db.session.get(Job, job_id)
+            # Another worker claimed it first; look again
+
+    def run(self, job):
+        # True if the job succeeded; otherwise it is rescheduled or failed
+        job_id, kind, attempts = job.id, job.kind, job.attempts
+        try:
+            if kind not in HANDLERS:
+                raise LookupError(f'no handler for {kind!r} jobs')
+            HANDLERS[kind](**json.loads(job.payload))
+            job.status = 'done'
+            job.finished_at = datetime.utcnow()
+            job.locked_until = None
+            job.last_error = None
+            db.session.commit()
+            return True
+        except Exception as e:
+            db.session.rollback()
+            current_app.logger.warning('job %s (%s) attempt %s failed: %r', job_id, kind, attempts, e)
+            self._retry_later(job_id, attempts, repr(e))
+            return False
+
+    def _retry_later(self, job_id, attempts, error):
+        config = current_app.config
+        now = datetime.utcnow()
+        if attempts >= config['JOB_MAX_ATTEMPTS']:
+            values = {'status': 'failed', 'finished_at': now}
+        else:
+            delay = min(config['JOB_RETRY_DELAY'] * 2 ** (attempts - 1), config['JOB_MAX_RETRY_DELAY'])
+            values = {'status': 'queued', 'run_at': now + timedelta(seconds=delay)}
+        db.session.execute(db.update(Job).where(Job.id == job_id)
+                           .values(locked_until=None, last_error=error, **values))
+        db.session.commit()
+
+    def run_pending(self, limit=None):
+        # Runs due jobs until there are none left; returns how many ran
+        count = 0
+        while limit is None or count < limit:
+            job = self.claim()
+            if job is None:
+                break
+            self.run(job)
+            count += 1
+        return count
+
+    def work(self, poll_interval, log=print):
+        # Runs jobs forever, checking for due ones every poll_interval seconds
+        while True:
+            ran = self.run_pending()
+            if ran:
+                log(f'ran {ran} jobs')
+            db.session.remove()
+            time.sleep(poll_interval)
+
+    def purge(self, before):
+        # Deletes jobs that finished successfully before the given time
+        deleted = db.session.execute(db.delete(Job).where(Job.status == 'done', Job.finished_at < before))
+        db.session.commit()
+        return deleted.rowcount
+
+    # In-process runner
+
+    def _committed(self, session):
+        if session.info.pop('jobs_enqueued', False) and current_app.config['JOBS_IN_PROCESS']:
+            self._wake()
+
+    def _wake(self):
+        # The thread is started on first use in each process, since threads
+        # don't survive gunicorn's fork of a preloaded app
+        state = current_app.extensions['jobs']
+        if state['pid'] != os.getpid():
+            with self.lock:
+                if state['pid'] != os.getpid():
+                    state['wake'] = threading.Event()
+                    state['thread'] = threading.Thread(
+                        target=self._run_in_process, args=(current_app._get_current_object(), state['wake']),
+                        name='jobs', daemon=True)
+                    state['thread'].start()
+                    state['pid'] = os.getpid()
+        state['wake'].set()
+
+    def _run_in_process(self, app, wake):
+        # Woken after commits that enqueue; the timeout picks up retries
+        while True:
+            wake.wait(app.config['JOB_POLL_INTERVAL'])
+            wake.clear()
+            with app.app_context():
+                try:
+                    self.run_pending()
+                except Exception:
+                    app.logger.exception('in-process job runner failed')
+
+
+job_queue = JobQueue()
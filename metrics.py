@@ -0,0 +1,233 @@
+import cProfile
+import heapq
+import os
+import random
+import threading
+import time
+
+from flask import g, request, has_request_context, before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Opt-in per-route instrumentation (METRICS_ENABLED). For every request it
+# records wall time, template render time and the number and total time of
+# SQL statements, aggregated per endpoint into fixed-bucket histograms so
+# memory stays bounded however long the process runs. With
+# PROFILE_SAMPLE_RATE > 0 a random sample of requests also runs under
+# cProfile, and the PROFILE_KEEP slowest sampled requests are kept as .prof
+# files in PROFILE_DIR (open them with pstats or snakeviz).
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SLOW_STATEMENTS = 5
+STATEMENT_CHARS = 300
+
+
+class RouteStats:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.wall_time = 0.0
+        self.max_wall_time = 0.0
+        self.template_time = 0.0
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.buckets = [0] * len(BUCKETS)
+        # min-heap of (seconds, statement), the slowest seen on this route
+        self.slow_statements = []
+
+    def add(self, wall, template, sql_count, sql_time, statements, error):
+        self.requests += 1
+        self.errors += error
+        self.wall_time += wall
+        self.max_wall_time = max(self.max_wall_time, wall)
+        self.template_time += template
+        self.sql_count += sql_count
+        self.sql_time += sql_time
+        for i, bound in enumerate(BUCKETS):
+            if wall <= bound:
+                self.buckets[i] += 1
+                break
+        for entry in statements:
+            if len(self.slow_statements) < SLOW_STATEMENTS:
+                heapq.heappush(self.slow_statements, entry)
+            elif entry[0] > self.slow_statements[0][0]:
+                heapq.heapreplace(self.slow_statements, entry)
+
+    def cumulative_buckets(self):
+        total = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            total += count
+            yield bound, total
+
+
+class Instrumentation:
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        self.routes = {}
+        self.profiles = []
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS_ENABLED', False)
+        app.config.setdefault('METRICS_TOKEN', None)
+        app.config.setdefault('PROFILE_SAMPLE_RATE', 0.0)
+        app.config.setdefault('PROFILE_KEEP', 10)
+        app.config.setdefault('PROFILE_DIR', os.path.join(app.instance_path, 'profiles'))
+        app.extensions['instrumentation'] = self
+        self.app = app
+        if not app.config['METRICS_ENABLED']:
+            return
+
+        app.before_request(self._start)
+        app.teardown_request(self._finish)
+        before_render_template.connect(self._template_start, app)
+        template_rendered.connect(self._template_end, app)
+        event.listen(Engine, 'before_cursor_execute', self._sql_start)
+        event.listen(Engine, 'after_cursor_execute', self._sql_end)
+
+    @property
+    def enabled(self):
+        return self.app.config['METRICS_ENABLED']
+
+    def _start(self):
+        g.metrics = {
+            'start': time.perf_counter(),
+            'template': 0.0, 'template_depth': 0, 'template_start': 0.0,
+            'sql_count': 0, 'sql_time': 0.0, 'statements': [],
+            'profiler': None,
+        }
+        rate = self.app.config['PROFILE_SAMPLE_RATE']
+        if rate and random.random() < rate:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # Another profiler is already active on this thread
+                return
+            g.metrics['profiler'] = profiler
+
+    def _current(self):
+        if has_request_context():
+            return g.get('metrics')
+        return None
+
+    # Only the outermost template is timed, so fragments rendered inside a
+    # page aren't counted twice
+    def _template_start(self, sender, template, context, **extra):
+        current = self._current()
+        if current is not None:
+            if not current['template_depth']:
+                current['template_start'] = time.perf_counter()
+            current['template_depth'] += 1
+
+    def _template_end(self, sender, template, context, **extra):
+        current = self._current()
+        if current is not None and current['template_depth']:
+            current['template_depth'] -= 1
+            if not current['template_depth']:
+                current['template'] += time.perf_counter() - current['template_start']
+
+    def _sql_start(self, conn, cursor, statement, parameters, context, executemany):
+        if self._current() is not None:
+            conn.info.setdefault('metrics_start', []).append(time.perf_counter())
+
+    def _sql_end(self, conn, cursor, statement, parameters, context, executemany):
+        current = self._current()
+        starts = conn.info.get('metrics_start')
+        if current is None or not starts:
+            return
+        elapsed = time.perf_counter() - starts.pop()
+        current['sql_count'] += 1
+        current['sql_time'] += elapsed
+        current['statements'].append((elapsed, statement[:STATEMENT_CHARS]))
+
+    def _finish(self, exc):
+        current = g.pop('metrics', None)
+        if current is None:
+            return
+        profiler = current['profiler']
+        if profiler is not None:
+            profiler.disable()
+        wall = time.perf_counter() - current['start']
+        endpoint = request.endpoint or 'unmatched'
+        statements = heapq.nlargest(SLOW_STATEMENTS, current['statements'])
+        with self.lock:
+            stats = self.routes.get(endpoint)
+            if stats is None:
+                stats = self.routes[endpoint] = RouteStats()
+            stats.add(wall, current['template'], current['sql_count'], current['sql_time'],
+                      statements, exc is not None)
+        if profiler is not None:
+            self._keep_profile(profiler, wall, endpoint)
+
+    def _keep_profile(self, profiler, wall, endpoint):
+        keep = self.app.config['PROFILE_KEEP']
+        with self.lock:
+            if len(self.profiles) >= keep and wall <= self.profiles[0][0]:
+                return
+            directory = self.app.config['PROFILE_DIR']
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, '%d-%s-%d-%dms.prof' % (
+                time.time(), endpoint, os.getpid(), wall * 1000))
+            profiler.dump_stats(path)
+            if len(self.profiles) >= keep:
+                _, evicted, _ = heapq.heapreplace(self.profiles, (wall, path, endpoint))
+                try:
+                    os.remove(evicted)
+                except OSError:
+                    pass
+            else:
+                heapq.heappush(self.profiles, (wall, path, endpoint))
+
+    def snapshot(self):
+        with self.lock:
+            routes = []
+            for endpoint, stats in self.routes.items():
+                n = stats.requests or 1
+                routes.append({
+                    'endpoint': endpoint,
+                    'requests': stats.requests,
+                    'errors': stats.errors,
+                    'avg_ms': stats.wall_time / n * 1000,
+                    'max_ms': stats.max_wall_time * 1000,
+                    'template_ms': stats.template_time / n * 1000,
+                    'queries': stats.sql_count / n,
+                    'sql_ms': stats.sql_time / n * 1000,
+                    'slow_statements': [(s * 1000, text) for s, text in
+                                        sorted(stats.slow_statements, reverse=True)],
+                })
+            profiles = [{'endpoint': endpoint, 'ms': wall * 1000, 'path': path}
+                        for wall, path, endpoint in sorted(self.profiles, reverse=True)]
+        routes.sort(key=lambda r: r['avg_ms'] * r['requests'], reverse=True)
+        return routes, profiles
+
+    def prometheus(self):
+        lines = [
+            '# HELP bookstore_request_duration_seconds Request wall time by endpoint.',
+            '# TYPE bookstore_request_duration_seconds histogram',
+        ]
+        with self.lock:
+            routes = sorted(self.routes.items())
+            for endpoint, stats in routes:
+                label = 'endpoint="%s"' % endpoint
+                for bound, count in stats.cumulative_buckets():
+                    lines.append('bookstore_request_duration_seconds_bucket{%s,le="%s"} %d' % (label, bound, count))
+                lines.append('bookstore_request_duration_seconds_bucket{%s,le="+Inf"} %d' % (label, stats.requests))
+                lines.append('bookstore_request_duration_seconds_sum{%s} %f' % (label, stats.wall_time))
+                lines.append('bookstore_request_duration_seconds_count{%s} %d' % (label, stats.requests))
+            for name, kind, help_text, attr in (
+                ('bookstore_request_errors_total', 'counter', 'Requests that raised an exception.', 'errors'),
+                ('bookstore_template_render_seconds_total', 'counter', 'Time spent rendering templates.', 'template_time'),
+                ('bookstore_sql_statements_total', 'counter', 'SQL statements executed.', 'sql_count'),
+                ('bookstore_sql_duration_seconds_total', 'counter', 'Time spent executing SQL.', 'sql_time'),
+            ):
+                lines.append('# HELP %s %s' % (name, help_text))
+                lines.append('# TYPE %s %s' % (name, kind))
+                for endpoint, stats in routes:
+                    lines.append('%s{endpoint="%s"} %s' % (name, endpoint, getattr(stats, attr)))
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self.lock:
+            self.routes.clear()
@@ -1,6 +1,6 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
+from passwords import password_hasher
 from datetime import datetime
 
 db = SQLAlchemy()
@@ -16,10 +16,10 @@ class User(UserMixin, db.Model):
     cart_items = db.relationship('CartItem', backref='user', lazy=True, cascade='all, delete-orphan')
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return password_hasher.check(self.password_hash, password)
 
 class Category(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -38,23 +38,58 @@ class Product(db.Model):
     featured = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    # Back keyset pagination for each catalog sort order, with and without
+    # a category filter. The price indexes carry stock so price-range and
+    # in-stock filters, and the grouped category facets query, are answered
+    # from the index alone.
+    __table_args__ = (
+        db.Index('ix_product_category_price_id_stock', 'category_id', 'price', 'id', 'stock'),
+        db.Index('ix_product_category_title_id', 'category_id', 'title', 'id'),
+        db.Index('ix_product_price_id_stock', 'price', 'id', 'stock'),
+        db.Index('ix_product_title_id', 'title', 'id'),
+    )
+
+# Indexes replaced by wider ones above; init_db drops them
+SUPERSEDED_INDEXES = ('ix_product_category_price_id', 'ix_product_price_id')
+
 class CartItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
     quantity = db.Column(db.Integer, default=1)
     product = db.relationship('Product')
 
-class Wishlist(db.Model):
+    __table_args__ = (
+        db.CheckConstraint('quantity > 0', name='ck_cart_item_quantity_positive'),
+    )
+
+# Time-limited stock hold behind each cart line. Available-to-sell is stock
+# minus the unexpired holds of other shoppers; see inventory.py.
+class StockReservation(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'product_id', name='uq_reservation_user_product'),
+        db.CheckConstraint('quantity > 0', name='ck_reservation_quantity_positive'),
+        # Covers the held-quantity sum per product without touching the table
+        db.Index('ix_reservation_product_expires', 'product_id', 'expires_at', 'quantity'),
+        db.Index('ix_reservation_expires', 'expires_at'),
+    )
+
+class Wishlist(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     product = db.relationship('Product')
 
 class Order(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     total = db.Column(db.Float, nullable=False)
     status = db.Column(db.String(20), default='pending')
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -62,8 +97,105 @@ class Order(db.Model):
 
 class OrderItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False)
+    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False, index=True)
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
     quantity = db.Column(db.Integer, nullable=False)
     price = db.Column(db.Float, nullable=False)
     product = db.relationship('Product')
+
+# Materialized best-seller counters, maintained by checkout() and rebuilt by
+# `flask rebuild-bestsellers`. order_count counts order lines per product.
+class ProductSales(db.Model):
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    order_count = db.Column(db.Integer, nullable=False, default=0, index=True)
+
+class ProductSalesDaily(db.Model):
+    day = db.Column(db.Date, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    order_count = db.Column(db.Integer, nullable=False, default=0)
+
+# Precomputed "customers also bought" ('bought') and "similar books"
+# ('wishlist') neighbors: for each product, the products most often bought
+# or wishlisted by the same customers, scored by how many customers did.
+# Rebuilt by `flask rebuild-recommendations`, updated after each checkout.
+class ProductNeighbor(db.Model):
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    kind = db.Column(db.String(16), primary_key=True)
+    neighbor_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    score = db.Column(db.Integer, nullable=False, default=0)
+
+# Dashboard rollups: running totals keyed by name ('products', 'users',
+# 'orders', 'revenue') and per-day order buckets, updated in the same
+# transaction as the writes they count and rebuilt by `flask reconcile-stats`.
+class StoreStat(db.Model):
+    name = db.Column(db.String(32), primary_key=True)
+    value = db.Column(db.Float, nullable=False, default=0)
+
+class DailySales(db.Model):
+    day = db.Column(db.Date, primary_key=True)
+    order_count = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0)
+
+# Server-side sessions (SESSION_BACKEND='sql'), keyed by a hash of the
+# session cookie; see sessions.py
+class ServerSession(db.Model):
+    __bind_key__ = 'sessions'
+    id = db.Column(db.String(64), primary_key=True)
+    data = db.Column(db.Text, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+# Background jobs (see jobs.py). key is an optional idempotency key: a job
+# is only enqueued once per key.
+class Job(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    key = db.Column(db.String(120), unique=True)
+    payload = db.Column(db.Text, nullable=False, default='{}')
+    status = db.Column(db.String(10), nullable=False, default='queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_until = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+    __table_args__ = (
+        db.Index('ix_job_status_run_at', 'status', 'run_at'),
+    )
+
+# Catalog files uploaded on the admin import page. A 'product_import' job
+# imports each one (see catalog_io.py), updating the counters after every
+# batch for the page to poll; finished_at is set once the import is done.
+class ProductImport(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    filename = db.Column(db.String(255), nullable=False)
+    upload_name = db.Column(db.String(64), nullable=False)
+    format = db.Column(db.String(10), nullable=False)
+    create_categories = db.Column(db.Boolean, nullable=False, default=False)
+    rows = db.Column(db.Integer, nullable=False, default=0)
+    inserted = db.Column(db.Integer, nullable=False, default=0)
+    updated = db.Column(db.Integer, nullable=False, default=0)
+    error_count = db.Column(db.Integer, nullable=False, default=0)
+    # JSON list of [line, message], the first MAX_REPORTED_ERRORS rejected rows
+    errors = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+
+# Products changed since the in-memory search index was built (see
+# search.py). Each worker applies the entries after the last id it has seen;
+# `flask purge-search-changes` deletes old ones.
+class SearchChange(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+    # Ids must never be reused after a purge, or workers would skip changes
+    __table_args__ = {'sqlite_autoincrement': True}
+
+# Contact form outbox; sent_at is set once the message has been mailed
+class ContactMessage(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    email = db.Column(db.String(120), nullable=False)
+    subject = db.Column(db.String(200), nullable=False)
+    message = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
@@ -0,0 +1,54 @@
+import smtplib
+from datetime import datetime
+from email.message import EmailMessage
+
+from flask import current_app
+from models import db, User, Order, OrderItem, ContactMessage
+from jobs import handler
+
+# Outgoing mail, sent from background jobs. With MAIL_SERVER unset messages
+# are only logged, which is what development wants.
+
+
+def send_mail(to, subject, body, reply_to=None):
+    config = current_app.config
+    if not config.get('MAIL_SERVER'):
+        current_app.logger.info('mail to %s: %s\n%s', to, subject, body)
+        return
+    message = EmailMessage()
+    message['From'] = config['MAIL_SENDER']
+    message['To'] = to
+    message['Subject'] = subject
+    if reply_to:
+        message['Reply-To'] = reply_to
+    message.set_content(body)
+    with smtplib.SMTP(config['MAIL_SERVER'], config['MAIL_PORT'], timeout=30) as smtp:
+        if config['MAIL_USE_TLS']:
+            smtp.starttls()
+        if config.get('MAIL_USERNAME'):
+            smtp.login(config['MAIL_USERNAME'], config['MAIL_PASSWORD'])
+        smtp.send_message(message)
+
+
+@handler('order_confirmation')
+def send_order_confirmation(order_id):
+    order = Order.query.options(db.selectinload(Order.items).joinedload(OrderItem.product))\
+        .filter_by(id=order_id).first()
+    if order is None:
+        return
+    user = db.session.get(User, order.user_id)
+    lines = [f'{item.quantity} x {item.product.title if item.product else "(removed)"}  '
+             f'${item.price * item.quantity:.2f}' for item in order.items]
+    send_mail(user.email, f'Your Bookstore order #{order.id}',
+              f'Hi {user.username},\n\nThanks for your order.\n\n' + '\n'.join(lines) +
+              f'\n\nTotal: ${order.total:.2f}\n')
+
+
+@handler('contact_message')
+def send_contact_message(message_id):
+    message = db.session.get(ContactMessage, message_id)
+    if message is None or message.sent_at is not None:
+        return
+    send_mail(current_app.config['CONTACT_EMAIL'], f'Contact form: {message.subject}',
+              f'From: {message.name} <{message.email}>\n\n{message.message}\n', reply_to=message.email)
+    message.sent_at = datetime.utcnow()
@@ -0,0 +1,78 @@
+from datetime import datetime
+
+from models import db, Product, CartItem, Order, OrderItem
+from jobs import job_queue
+import bestsellers
+import inventory
+import rollups
+
+# Order placement as a handful of set-based statements: one read of the cart
+# joined to its products, one conditional stock UPDATE for every line, one
+# bulk OrderItem insert and one cart DELETE, all in a single transaction
+# together with the best-seller and dashboard counters. Slower follow-up
+# work (recommendations, the confirmation mail) is enqueued as jobs in the
+# same transaction, keyed by order id.
+
+
+class OutOfStock(Exception):
+    def __init__(self, products):
+        super().__init__(', '.join(p.title for p in products))
+        self.products = products
+
+
+def load_cart(user_id):
+    return CartItem.query.options(db.joinedload(CartItem.product))\
+        .filter(CartItem.user_id == user_id)\
+        .order_by(CartItem.id).all()
+
+
+def place_order(user_id):
+    # Returns the committed Order, None for an empty cart, or raises
+    # OutOfStock (with nothing written) if any line can't be fulfilled
+    rows = db.session.query(CartItem.product_id, CartItem.quantity, Product.price)\
+        .join(Product, Product.id == CartItem.product_id)\
+        .filter(CartItem.user_id == user_id).all()
+    if not rows:
+        return None
+
+    quantities = {}
+    prices = {}
+    for product_id, quantity, price in rows:
+        quantities[product_id] = quantities.get(product_id, 0) + quantity
+        prices[product_id] = price
+
+    # Only rows with enough stock left over after other shoppers' cart holds
+    # are decremented; the check and the write happen in the same statement
+    # so concurrent buyers can't both pass it
+    wanted = db.case(quantities, value=Product.id)
+    result = db.session.execute(
+        db.update(Product)
+        .where(Product.id.in_(quantities),
+               Product.stock - inventory.held_by_others(user_id, datetime.utcnow()) >= wanted)
+        .values(stock=Product.stock - wanted)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount != len(quantities):
+        db.session.rollback()
+        products = Product.query.filter(Product.id.in_(quantities)).all()
+        free = inventory.available(products, user_id)
+        raise OutOfStock([p for p in products if free[p.id] < quantities[p.id]])
+
+    total = sum(prices[pid] * quantity for pid, quantity in quantities.items())
+    order = Order(user_id=user_id, total=total, status='completed')
+    db.session.add(order)
+    db.session.flush()
+
+    db.session.execute(db.insert(OrderItem), [
+        {'order_id': order.id, 'product_id': pid, 'quantity': quantity, 'price': prices[pid]}
+        for pid, quantity in quantities.items()
+    ])
+    bestsellers.record_sales(order.id, order.created_at)
+    rollups.record_order(total, order.created_at)
+    db.session.execute(db.delete(CartItem).where(CartItem.user_id == user_id))
+    inventory.release(user_id, quantities)
+    job_queue.enqueue('order_recommendations', {'user_id': user_id, 'order_id': order.id},
+                      key=f'order_recommendations:{order.id}')
+    job_queue.enqueue('order_confirmation', {'order_id': order.id}, key=f'order_confirmation:{order.id}')
+    db.session.commit()
+    return order
@@ -0,0 +1,113 @@
+import base64
+import json
+import math
+
+from sqlalchemy import and_, or_
+
+# Keyset (cursor) pagination. A page is fetched by seeking past the sort key
+# of the last row already shown, so deep pages cost the same as the first one
+# as long as an index covers the sort keys.
+#
+# keys is a list of (column, ascending) pairs of non-nullable columns and
+# must end with a unique one (normally the primary key) so every row has a
+# distinct position.
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(values, direction='next'):
+    payload = json.dumps({'k': list(values), 'd': direction}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def _is_key_value(value):
+    # The strings and numbers encode_cursor writes; sort keys are never NULL
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, float):
+        return math.isfinite(value)
+    return isinstance(value, (str, int))
+
+
+def decode_cursor(cursor, size=None):
+    # size is the number of sort keys the cursor must carry values for
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        values, direction = payload['k'], payload['d']
+    except (ValueError, KeyError, TypeError) as e:
+        raise InvalidCursor(str(e))
+    if direction not in ('next', 'prev') or not isinstance(values, list):
+        raise InvalidCursor('malformed cursor')
+    if size is not None and len(values) != size:
+        raise InvalidCursor('cursor does not match sort order')
+    if not all(_is_key_value(v) for v in values):
+        raise InvalidCursor('malformed cursor')
+    return values, direction
+
+
+def _seek(keys, values):
+    # (k1, k2, ...) strictly after values in the given ordering, expanded so
+    # mixed ascending/descending keys work on every backend. The redundant
+    # bound on the leading key lets the planner start an index range scan.
+    clauses = []
+    for i, (column, ascending) in enumerate(keys):
+        equal = [keys[j][0] == values[j] for j in range(i)]
+        beyond = column > values[i] if ascending else column < values[i]
+        clauses.append(and_(*equal, beyond))
+    leading, ascending = keys[0]
+    bound = leading >= values[0] if ascending else leading <= values[0]
+    return and_(bound, or_(*clauses))
+
+
+class Page:
+    def __init__(self, items, next_cursor, prev_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+def paginate(query, keys, per_page, cursor=None, key_values=None):
+    # key_values(item) returns the sort key tuple for a result row
+    direction = 'next'
+    if cursor:
+        values, direction = decode_cursor(cursor, len(keys))
+        if direction == 'next':
+            query = query.filter(_seek(keys, values))
+        else:
+            query = query.filter(_seek([(c, not asc) for c, asc in keys], values))
+
+    if direction == 'next':
+        order = [c.asc() if asc else c.desc() for c, asc in keys]
+    else:
+        order = [c.desc() if asc else c.asc() for c, asc in keys]
+    rows = query.order_by(None).order_by(*order).limit(per_page + 1).all()
+
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if direction == 'prev':
+        rows.reverse()
+
+    next_cursor = prev_cursor = None
+    if rows:
+        first, last = key_values(rows[0]), key_values(rows[-1])
+        if direction == 'next':
+            if more:
+                next_cursor = encode_cursor(last, 'next')
+            if cursor:
+                prev_cursor = encode_cursor(first, 'prev')
+        else:
+            next_cursor = encode_cursor(last, 'next')
+            if more:
+                prev_cursor = encode_cursor(first, 'prev')
+    return Page(rows, next_cursor, prev_cursor)
@@ -0,0 +1,160 @@
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+from flask import current_app
+from werkzeug.security import generate_password_hash, check_password_hash
+
+# Password hashing and login throttling.
+#
+# Hashes use PASSWORD_HASH_METHOD (any Werkzeug method string, such as
+# 'scrypt:32768:8:1' or 'pbkdf2:sha256:600000') and run on the calling
+# request's thread, which is busy until the hash is done. hashlib releases
+# the GIL while it hashes, so the worker's other threads keep serving. At
+# most PASSWORD_HASH_WORKERS hashes run at once per process and at most
+# PASSWORD_HASH_QUEUE may be running or waiting; beyond that HashingBusy is
+# raised rather than queueing logins behind each other. A successful login
+# with a hash made under other settings is rehashed with the current ones.
+#
+# Failed logins are counted per username and per client address in a
+# sliding window of LOGIN_FAILURE_WINDOW seconds. The counts live in each
+# worker's memory, so with several workers the effective limit is higher.
+
+
+class HashingBusy(Exception):
+    pass
+
+
+class LoginLimiter:
+    def __init__(self, window, max_keys=100000):
+        self.window = window
+        self.max_keys = max_keys
+        self.failures = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _recent(self, key, now):
+        times = self.failures.get(key)
+        if times is None:
+            return None
+        while times and times[0] <= now - self.window:
+            times.popleft()
+        if not times:
+            del self.failures[key]
+            return None
+        return times
+
+    def retry_after(self, limits, now=None):
+        # Seconds until every (key, limit) pair is under its limit; 0 if it
+        # already is
+        now = now or time.time()
+        wait = 0
+        with self.lock:
+            for key, limit in limits:
+                times = self._recent(key, now)
+                if times and len(times) >= limit:
+                    wait = max(wait, times[-limit] + self.window - now)
+        return int(wait) + 1 if wait else 0
+
+    def fail(self, keys, now=None):
+        now = now or time.time()
+        with self.lock:
+            for key in keys:
+                times = self._recent(key, now)
+                if times is None:
+                    times = self.failures[key] = deque()
+                times.append(now)
+                self.failures.move_to_end(key)
+            while len(self.failures) > self.max_keys:
+                self.failures.popitem(last=False)
+
+    def reset(self, keys):
+        with self.lock:
+            for key in keys:
+                self.failures.pop(key, None)
+
+
+class PasswordHasher:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PASSWORD_HASH_METHOD', 'scrypt')
+        app.config.setdefault('PASSWORD_HASH_WORKERS', os.cpu_count() or 2)
+        app.config.setdefault('PASSWORD_HASH_QUEUE', 64)
+        app.config.setdefault('LOGIN_MAX_FAILURES', 5)
+        app.config.setdefault('LOGIN_MAX_FAILURES_PER_IP', 50)
+        app.config.setdefault('LOGIN_FAILURE_WINDOW', 300)
+        app.extensions['passwords'] = {
+            'running': threading.BoundedSemaphore(app.config['PASSWORD_HASH_WORKERS']),
+            'slots': threading.BoundedSemaphore(app.config['PASSWORD_HASH_QUEUE']),
+            'prefix': None,
+            'dummy': None,
+            'limiter': LoginLimiter(app.config['LOGIN_FAILURE_WINDOW']),
+        }
+
+    @property
+    def state(self):
+        return current_app.extensions['passwords']
+
+    def _run(self, fn, *args):
+        state = self.state
+        if not state['slots'].acquire(blocking=False):
+            raise HashingBusy()
+        try:
+            with state['running']:
+                return fn(*args)
+        finally:
+            state['slots'].release()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, current_app.config['PASSWORD_HASH_METHOD'])
+
+    def check(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
+
+    def _current_prefix(self):
+        # The method string as Werkzeug records it, with defaults filled in
+        state = self.state
+        if state['prefix'] is None:
+            state['dummy'] = self.hash(os.urandom(16).hex())
+            state['prefix'] = state['dummy'].split('$', 1)[0]
+        return state['prefix']
+
+    def needs_rehash(self, password_hash):
+        return password_hash.split('$', 1)[0] != self._current_prefix()
+
+    def authenticate(self, user, password):
+        # True if password is the user's, rehashing it in the caller's
+        # transaction if it was hashed under other settings
+        if user is None:
+            # Spend as long as a real check so unknown usernames don't
+            # answer faster
+            self._current_prefix()
+            self.check(self.state['dummy'], password)
+            return False
+        if not self.check(user.password_hash, password):
+            return False
+        if self.needs_rehash(user.password_hash):
+            user.password_hash = self.hash(password)
+        return True
+
+    # Failed-login throttling
+
+    def _limits(self, username, address):
+        config = current_app.config
+        return [(f'user:{username.lower()}', config['LOGIN_MAX_FAILURES']),
+                (f'ip:{address}', config['LOGIN_MAX_FAILURES_PER_IP'])]
+
+    def retry_after(self, username, address):
+        return self.state['limiter'].retry_after(self._limits(username, address))
+
+    def login_failed(self, username, address):
+        self.state['limiter'].fail([key for key, _ in self._limits(username, address)])
+
+    def login_succeeded(self, username):
+        self.state['limiter'].reset([f'user:{username.lower()}'])
+
+
+password_hasher = PasswordHasher()
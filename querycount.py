@@ -0,0 +1,45 @@
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from models import db
+
+# Counts SQL statements sent to the database, for catching N+1 regressions:
+#
+#     with app.app_context(), assert_max_queries(4):
+#         client.get('/my-orders')
+#
+# With no engine given, statements on every bind are counted (the sessions
+# bind included), not just the main engine's.
+
+
+class QueryCounter:
+    def __init__(self, engine=None):
+        self.engines = [engine] if engine is not None else None
+        self.statements = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    def __enter__(self):
+        if self.engines is None:
+            self.engines = list(set(db.engines.values()))
+        for engine in self.engines:
+            event.listen(engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, *exc):
+        for engine in self.engines:
+            event.remove(engine, 'before_cursor_execute', self._record)
+
+
+@contextmanager
+def assert_max_queries(limit, engine=None):
+    with QueryCounter(engine) as counter:
+        yield counter
+    if counter.count > limit:
+        listing = '\n'.join(f'  {i}. {s}' for i, s in enumerate(counter.statements, 1))
+        raise AssertionError(f'{counter.count} queries executed, expected at most {limit}:\n{listing}')
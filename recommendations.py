@@ -0,0 +1,130 @@
+from flask import current_app
+from database import increment_from
+from jobs import handler
+from models import db, Product, Order, OrderItem, Wishlist, ProductNeighbor
+
+# Item-to-item recommendations read from the product_neighbor table, so the
+# product page costs one indexed query however large the order history is.
+#
+# Two products are neighbors when the same customer bought (kind 'bought')
+# or wishlisted ('wishlist') both; the score is the number of such customers.
+# rebuild() computes every pair in the database with a self-join of the
+# (customer, product) baskets, which only ever touches pairs that actually
+# co-occur, and keeps the RECOMMENDATIONS_KEEP best per product. Customers
+# with more than RECOMMENDATIONS_MAX_BASKET products are left out: they add
+# many pairs and little signal.
+#
+# record_purchase() runs as a job after each checkout and adds the order's
+# new pairs to the stored scores. A pair that had fallen out of a product's
+# top list starts again from one, so the scores drift low for long-tail
+# pairs until the next rebuild.
+
+KINDS = ('bought', 'wishlist')
+
+
+def _baskets(kind):
+    # Distinct (basket_id, product_id) rows, one basket per customer
+    if kind == 'bought':
+        rows = db.select(Order.user_id.label('basket_id'), OrderItem.product_id)\
+            .join(Order, Order.id == OrderItem.order_id)
+    else:
+        rows = db.select(Wishlist.user_id.label('basket_id'), Wishlist.product_id)
+    rows = rows.distinct().subquery()
+    sizes = db.select(rows.c.basket_id).group_by(rows.c.basket_id)\
+        .having(db.func.count().between(2, current_app.config['RECOMMENDATIONS_MAX_BASKET']))
+    return db.select(rows.c.basket_id, rows.c.product_id).where(rows.c.basket_id.in_(sizes)).subquery()
+
+
+def _ranked(pairs):
+    # pairs has product_id, neighbor_id and score columns
+    return db.select(pairs, db.func.row_number().over(
+        partition_by=pairs.c.product_id,
+        order_by=(pairs.c.score.desc(), pairs.c.neighbor_id),
+    ).label('rank')).subquery()
+
+
+def rebuild():
+    # Recompute every neighbor list from orders and wishlists; returns the
+    # number of rows written
+    keep = current_app.config['RECOMMENDATIONS_KEEP']
+    table = ProductNeighbor.__table__
+    db.session.execute(table.delete())
+    for kind in KINDS:
+        baskets = _baskets(kind)
+        a = baskets.alias('a')
+        b = baskets.alias('b')
+        pairs = db.select(a.c.product_id, b.c.product_id.label('neighbor_id'), db.func.count().label('score'))\
+            .join(b, db.and_(b.c.basket_id == a.c.basket_id, b.c.product_id != a.c.product_id))\
+            .group_by(a.c.product_id, b.c.product_id)\
+            .subquery()
+        ranked = _ranked(pairs)
+        db.session.execute(table.insert().from_select(
+            ['product_id', 'kind', 'neighbor_id', 'score'],
+            db.select(ranked.c.product_id, db.literal(kind), ranked.c.neighbor_id, ranked.c.score)
+            .where(ranked.c.rank <= keep)
+        ))
+    db.session.commit()
+    return db.session.query(ProductNeighbor).count()
+
+
+def _trim(kind, product_ids):
+    # Drop all but the best RECOMMENDATIONS_KEEP neighbors of each product
+    pairs = db.select(ProductNeighbor.product_id, ProductNeighbor.neighbor_id, ProductNeighbor.score)\
+        .where(ProductNeighbor.kind == kind, ProductNeighbor.product_id.in_(product_ids))\
+        .subquery()
+    ranked = _ranked(pairs)
+    db.session.execute(db.delete(ProductNeighbor).where(
+        ProductNeighbor.kind == kind,
+        db.tuple_(ProductNeighbor.product_id, ProductNeighbor.neighbor_id).in_(
+            db.select(ranked.c.product_id, ranked.c.neighbor_id)
+            .where(ranked.c.rank > current_app.config['RECOMMENDATIONS_KEEP']))
+    ))
+
+
+@handler('order_recommendations')
+def record_purchase(user_id, order_id):
+    # Pairs each product the customer buys for the first time with everything
+    # else they have bought, as one INSERT ... SELECT. Only earlier orders
+    # count as history, so a pair spread over two orders is counted by the
+    # later one alone, whichever job runs first.
+    ordered = db.select(OrderItem.product_id).where(OrderItem.order_id == order_id)
+    earlier = db.select(OrderItem.product_id).join(Order, Order.id == OrderItem.order_id)\
+        .where(Order.user_id == user_id, Order.id < order_id)
+    history = db.union(ordered, earlier).subquery('history')
+    new = db.except_(ordered, earlier).subquery('new')
+    history_size, new_count = db.session.execute(db.select(
+        db.select(db.func.count()).select_from(history).scalar_subquery(),
+        db.select(db.func.count()).select_from(new).scalar_subquery(),
+    )).one()
+    if not new_count or history_size > current_app.config['RECOMMENDATIONS_MAX_BASKET']:
+        return
+    different = new.c.product_id != history.c.product_id
+    pairs = db.union(
+        db.select(new.c.product_id.label('product_id'), history.c.product_id.label('neighbor_id')).where(different),
+        db.select(history.c.product_id, new.c.product_id).where(different),
+    ).subquery('pairs')
+    # Ordered so concurrent jobs lock rows in the same order
+    increment_from(ProductNeighbor,
+                   db.select(pairs.c.product_id, db.literal('bought'), pairs.c.neighbor_id, db.literal(1))
+                   .order_by(pairs.c.product_id, pairs.c.neighbor_id),
+                   ['product_id', 'kind', 'neighbor_id'], ['score'])
+    # Every product in the history gained a neighbor
+    _trim('bought', db.select(history.c.product_id))
+
+
+def neighbors(product_id, limit=None):
+    # {kind: [Product]} of in-stock neighbors, best first; a product shown
+    # under 'bought' isn't repeated under 'wishlist'
+    limit = limit or current_app.config['RECOMMENDATIONS_SHOWN']
+    rows = db.session.query(ProductNeighbor.kind, Product)\
+        .join(Product, Product.id == ProductNeighbor.neighbor_id)\
+        .filter(ProductNeighbor.product_id == product_id, Product.stock > 0)\
+        .order_by(ProductNeighbor.kind, ProductNeighbor.score.desc(), ProductNeighbor.neighbor_id)\
+        .all()
+    found = {kind: [] for kind in KINDS}
+    shown = set()
+    for kind, product in rows:
+        if len(found[kind]) < limit and product.id not in shown:
+            found[kind].append(product)
+            shown.add(product.id)
+    return found
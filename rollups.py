@@ -0,0 +1,86 @@
+from datetime import date, datetime, timedelta
+
+from database import increment
+from models import db, User, Product, Order, StoreStat, DailySales
+
+# Precomputed dashboard statistics. Writers call add() / record_order()
+# before they commit, so a rollup is never out of step with the rows it
+# counts; reconcile() recomputes everything from the source tables and
+# reports any drift it had to correct.
+
+STATS = ('products', 'users', 'orders', 'revenue')
+
+
+def add(**deltas):
+    # Sorted so concurrent writers lock stat rows in the same order
+    for name in sorted(deltas):
+        if deltas[name]:
+            increment(StoreStat, {'name': name}, value=deltas[name])
+
+
+def record_order(total, when=None):
+    day = (when or datetime.utcnow()).date()
+    add(orders=1, revenue=total)
+    increment(DailySales, {'day': day}, order_count=1, revenue=total)
+
+
+def totals():
+    values = dict(db.session.query(StoreStat.name, StoreStat.value))
+    result = {name: int(values.get(name) or 0) for name in STATS}
+    result['revenue'] = round(values.get('revenue') or 0.0, 2)
+    return result
+
+
+def daily(days=14, today=None):
+    # (day, order count, revenue) for each of the last days, oldest first,
+    # with zeros for days without orders
+    today = today or datetime.utcnow().date()
+    start = today - timedelta(days=days - 1)
+    buckets = {row.day: row for row in DailySales.query.filter(DailySales.day >= start)}
+    trend = []
+    for offset in range(days):
+        day = start + timedelta(days=offset)
+        row = buckets.get(day)
+        trend.append((day, row.order_count if row else 0, round(row.revenue, 2) if row else 0.0))
+    return trend
+
+
+def _actual():
+    stats = {
+        'products': db.session.query(db.func.count(Product.id)).scalar(),
+        'users': db.session.query(db.func.count(User.id)).scalar(),
+        'orders': db.session.query(db.func.count(Order.id)).scalar(),
+        'revenue': round(db.session.query(db.func.sum(Order.total)).scalar() or 0.0, 2),
+    }
+    day = db.func.date(Order.created_at)
+    buckets = {}
+    for value, count, revenue in db.session.query(day, db.func.count(Order.id), db.func.sum(Order.total))\
+            .group_by(day):
+        # SQLite returns date() as text
+        value = value if isinstance(value, date) else date.fromisoformat(value)
+        buckets[value] = (count, round(revenue or 0.0, 2))
+    return stats, buckets
+
+
+def reconcile():
+    # Rebuilds every rollup from scratch and returns the drift that was
+    # found as (name, stored, actual) tuples
+    stats, buckets = _actual()
+    stored = totals()
+    stored_buckets = {row.day: (row.order_count, round(row.revenue, 2)) for row in DailySales.query}
+
+    drift = [(name, stored[name], stats[name]) for name in STATS if stored[name] != stats[name]]
+    for day in sorted(set(buckets) | set(stored_buckets)):
+        if stored_buckets.get(day) != buckets.get(day):
+            drift.append((day.isoformat(), stored_buckets.get(day, (0, 0.0)), buckets.get(day, (0, 0.0))))
+
+    db.session.execute(StoreStat.__table__.delete())
+    db.session.execute(DailySales.__table__.delete())
+    db.session.execute(db.insert(StoreStat), [{'name': name, 'value': stats[name]} for name in STATS])
+    if buckets:
+        db.session.execute(db.insert(DailySales), [
+            {'day': day, 'order_count': count, 'revenue': revenue}
+            for day, (count, revenue) in buckets.items()
+        ])
+    db.session.commit()
+    return drift
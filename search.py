@@ -0,0 +1,457 @@
+import math
+import re
+import threading
+import unicodedata
+from bisect import bisect_left
+from collections import defaultdict
+
+from flask import current_app
+from sqlalchemy import text
+from models import db, Product, SearchChange
+
+# Search over Product title, author and description.
+#
+# On SQLite builds with FTS5 the index is an external-content FTS5 table kept
+# in sync with the product table by triggers, so every writer (admin routes,
+# imports, raw SQL) updates it inside its own transaction. Elsewhere a
+# per-process inverted index is built from the product table on first use and
+# updated by the admin routes through index_product / remove_product.
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+# Relative weight of a hit in each field when ranking results
+FIELD_WEIGHTS = {'title': 10.0, 'author': 5.0, 'description': 1.0}
+
+
+def tokenize(value):
+    if not value:
+        return []
+    value = unicodedata.normalize('NFKD', value)
+    value = ''.join(ch for ch in value if not unicodedata.combining(ch))
+    return TOKEN_RE.findall(value.lower())
+
+
+def max_typos(term):
+    if len(term) <= 3:
+        return 0
+    if len(term) <= 6:
+        return 1
+    return 2
+
+
+def edit_distance(a, b, limit):
+    # Levenshtein distance with adjacent transpositions, giving up as soon as
+    # every cell in a row exceeds limit.
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    prev_prev = None
+    prev = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        row = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            row[j] = min(prev[j] + 1, row[j - 1] + 1, prev[j - 1] + cost)
+            if (prev_prev is not None and i > 1 and j > 1
+                    and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]):
+                row[j] = min(row[j], prev_prev[j - 2] + 1)
+        if min(row) > limit:
+            return limit + 1
+        prev_prev, prev = prev, row
+    return prev[-1]
+
+
+def close_terms(term, candidates):
+    limit = max_typos(term)
+    if not limit:
+        return []
+    return [c for c in candidates if c != term and edit_distance(term, c, limit) <= limit]
+
+
+class FTS5Backend:
+    name = 'fts5'
+    maintained_by_triggers = True
+
+    def __init__(self, weights):
+        self.weights = ', '.join(str(w) for w in weights)
+
+    @staticmethod
+    def available(engine):
+        if engine.dialect.name != 'sqlite':
+            return False
+        with engine.connect() as conn:
+            try:
+                conn.execute(text('CREATE VIRTUAL TABLE temp.fts5_probe USING fts5(x)'))
+                conn.execute(text('DROP TABLE temp.fts5_probe'))
+            except Exception:
+                return False
+        return True
+
+    def setup(self, engine):
+        with engine.begin() as conn:
+            exists = conn.execute(text(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'product_fts'"
+            )).first()
+            conn.execute(text(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS product_fts USING fts5("
+                "title, author, description, content='product', content_rowid='id', "
+                "tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+            ))
+            conn.execute(text(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS product_fts_vocab "
+                "USING fts5vocab(product_fts, 'row')"
+            ))
+            conn.execute(text(
+                "CREATE TRIGGER IF NOT EXISTS product_fts_ai AFTER INSERT ON product BEGIN "
+                "INSERT INTO product_fts(rowid, title, author, description) "
+                "VALUES (new.id, new.title, new.author, new.description); END"
+            ))
+            conn.execute(text(
+                "CREATE TRIGGER IF NOT EXISTS product_fts_ad AFTER DELETE ON product BEGIN "
+                "INSERT INTO product_fts(product_fts, rowid, title, author, description) "
+                "VALUES ('delete', old.id, old.title, old.author, old.description); END"
+            ))
+            conn.execute(text(
+                "CREATE TRIGGER IF NOT EXISTS product_fts_au "
+                "AFTER UPDATE OF title, author, description ON product BEGIN "
+                "INSERT INTO product_fts(product_fts, rowid, title, author, description) "
+                "VALUES ('delete', old.id, old.title, old.author, old.description); "
+                "INSERT INTO product_fts(rowid, title, author, description) "
+                "VALUES (new.id, new.title, new.author, new.description); END"
+            ))
+            if not exists:
+                conn.execute(text("INSERT INTO product_fts(product_fts) VALUES ('rebuild')"))
+
+    def rebuild(self):
+        db.session.execute(text("INSERT INTO product_fts(product_fts) VALUES ('rebuild')"))
+
+    # The triggers keep product_fts in step with the product table.
+    def index_product(self, product):
+        pass
+
+    def remove_product(self, product_id):
+        pass
+
+    def _match(self, expression, limit):
+        rows = db.session.execute(text(
+            'SELECT rowid FROM product_fts WHERE product_fts MATCH :q '
+            'ORDER BY bm25(product_fts, %s) LIMIT :limit' % self.weights
+        ), {'q': expression, 'limit': limit})
+        return [row[0] for row in rows]
+
+    def _matches_any(self, expression):
+        return db.session.execute(text('SELECT 1 FROM product_fts WHERE product_fts MATCH :q LIMIT 1'),
+                                  {'q': expression}).first() is not None
+
+    def _variants(self, term):
+        limit = max_typos(term)
+        if not limit:
+            return []
+        rows = db.session.execute(text(
+            'SELECT term FROM product_fts_vocab WHERE term >= :lo AND term < :hi '
+            'AND length(term) BETWEEN :min_len AND :max_len'
+        ), {'lo': term[0], 'hi': chr(ord(term[0]) + 1),
+            'min_len': len(term) - limit, 'max_len': len(term) + limit})
+        return close_terms(term, [row[0] for row in rows])
+
+    def _expression(self, terms):
+        exact = ' '.join('"%s"*' % t for t in terms)
+        if self._matches_any(exact):
+            return exact
+        # Nothing matched as typed: allow near-miss spellings
+        groups = []
+        for term in terms:
+            options = ['"%s"*' % term] + ['"%s"' % v for v in self._variants(term)]
+            groups.append('(' + ' OR '.join(options) + ')')
+        return ' '.join(groups)
+
+    def search(self, terms, limit):
+        return self._match(self._expression(terms), limit)
+
+    def matches(self, terms):
+        return text(
+            'SELECT rowid AS product_id, bm25(product_fts, %s) AS score '
+            'FROM product_fts WHERE product_fts MATCH :q' % self.weights
+        ).bindparams(q=self._expression(terms))\
+            .columns(product_id=db.Integer, score=db.Float).subquery('matches')
+
+
+SEARCH_MATCH = db.table('search_match', db.column('product_id', db.Integer), db.column('score', db.Float))
+
+
+class MemoryBackend:
+    # Each process keeps its own index. Writers log the products they
+    # changed in the search_change table; every search first applies the
+    # entries after the last one this process has seen, re-reading just
+    # those products. Only a process that fell behind a purge of the log
+    # rebuilds from scratch.
+    name = 'python'
+    maintained_by_triggers = False
+    # Products re-read per query while applying changes
+    chunk_size = 500
+
+    # Okapi BM25 parameters
+    k1 = 1.2
+    b = 0.75
+
+    def __init__(self, weights):
+        self.weights = weights
+        self.lock = threading.Lock()
+        self.postings = defaultdict(dict)
+        self.doc_terms = {}
+        self.doc_lengths = {}
+        self.total_length = 0.0
+        self.vocabulary = []
+        self.vocabulary_dirty = False
+        self.version = None
+
+    def setup(self, engine):
+        self.rebuild()
+
+    def _log(self, product_id):
+        # Records a change this process has already applied to its own
+        # index; it is skipped here unless another process logged one
+        # meanwhile
+        seen = self.version
+        change = SearchChange(product_id=product_id)
+        db.session.add(change)
+        db.session.commit()
+        with self.lock:
+            if seen is not None and change.id == seen + 1:
+                self.version = max(self.version, change.id)
+
+    def _apply(self, product_ids):
+        for start in range(0, len(product_ids), self.chunk_size):
+            chunk = product_ids[start:start + self.chunk_size]
+            rows = {row.id: row for row in db.session.query(
+                Product.id, Product.title, Product.author, Product.description).filter(Product.id.in_(chunk))}
+            with self.lock:
+                for product_id in chunk:
+                    self._remove(product_id)
+                    row = rows.get(product_id)
+                    if row is not None:
+                        self._add(row.id, row.title, row.author, row.description)
+                self.vocabulary_dirty = True
+
+    def _refresh(self):
+        if self.version is None:
+            self.rebuild()
+            return
+        changes = db.session.query(SearchChange.id, SearchChange.product_id)\
+            .filter(SearchChange.id > self.version).order_by(SearchChange.id).all()
+        if not changes:
+            return
+        # purge() always keeps the newest entry, so a gap before the oldest
+        # one means entries this process never saw were purged
+        oldest = db.session.query(db.func.min(SearchChange.id)).scalar()
+        if oldest > self.version + 1:
+            self.rebuild()
+            return
+        self._apply(list(dict.fromkeys(product_id for _, product_id in changes)))
+        with self.lock:
+            self.version = max(self.version, changes[-1][0])
+
+    def rebuild(self):
+        # Read first: a change logged during the rebuild is applied next time
+        version = db.session.query(db.func.max(SearchChange.id)).scalar() or 0
+        rows = db.session.query(Product.id, Product.title, Product.author, Product.description)\
+            .execution_options(yield_per=1000)
+        with self.lock:
+            self.postings = defaultdict(dict)
+            self.doc_terms = {}
+            self.doc_lengths = {}
+            self.total_length = 0.0
+            for row in rows:
+                self._add(row.id, row.title, row.author, row.description)
+            self.vocabulary_dirty = True
+            self.version = version
+
+    def _add(self, product_id, title, author, description):
+        frequencies = defaultdict(float)
+        for weight, value in zip(self.weights, (title, author, description)):
+            for term in tokenize(value):
+                frequencies[term] += weight
+        length = sum(frequencies.values())
+        for term, frequency in frequencies.items():
+            self.postings[term][product_id] = frequency
+        self.doc_terms[product_id] = list(frequencies)
+        self.doc_lengths[product_id] = length
+        self.total_length += length
+
+    def _remove(self, product_id):
+        terms = self.doc_terms.pop(product_id, None)
+        if terms is None:
+            return
+        self.total_length -= self.doc_lengths.pop(product_id)
+        for term in terms:
+            docs = self.postings[term]
+            docs.pop(product_id, None)
+            if not docs:
+                del self.postings[term]
+
+    def index_product(self, product):
+        with self.lock:
+            self._remove(product.id)
+            self._add(product.id, product.title, product.author, product.description)
+            self.vocabulary_dirty = True
+        self._log(product.id)
+
+    def remove_product(self, product_id):
+        with self.lock:
+            self._remove(product_id)
+            self.vocabulary_dirty = True
+        self._log(product_id)
+
+    def products_changed(self, product_ids):
+        # Bulk writers: logs the ids for every process, this one included
+        db.session.execute(db.insert(SearchChange), [{'product_id': pid} for pid in product_ids])
+        db.session.commit()
+
+    def _expand(self, term, fuzzy):
+        # Prefix matches from the sorted vocabulary, plus near misses if fuzzy
+        if self.vocabulary_dirty:
+            self.vocabulary = sorted(self.postings)
+            self.vocabulary_dirty = False
+        expanded = []
+        i = bisect_left(self.vocabulary, term)
+        while i < len(self.vocabulary) and self.vocabulary[i].startswith(term):
+            expanded.append(self.vocabulary[i])
+            i += 1
+        if fuzzy:
+            limit = max_typos(term)
+            lo = bisect_left(self.vocabulary, term[0])
+            hi = bisect_left(self.vocabulary, chr(ord(term[0]) + 1))
+            candidates = [t for t in self.vocabulary[lo:hi] if abs(len(t) - len(term)) <= limit]
+            expanded.extend(close_terms(term, candidates))
+        return expanded
+
+    def _score(self, terms, fuzzy):
+        docs = len(self.doc_lengths)
+        if not docs:
+            return {}
+        average_length = self.total_length / docs or 1.0
+        scores = None
+        for term in terms:
+            term_scores = defaultdict(float)
+            for expanded in self._expand(term, fuzzy):
+                postings = self.postings[expanded]
+                idf = math.log(1 + (docs - len(postings) + 0.5) / (len(postings) + 0.5))
+                # Exact hits outrank prefix and typo expansions of the same term
+                boost = 1.0 if expanded == term else 0.5
+                for product_id, frequency in postings.items():
+                    norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[product_id] / average_length)
+                    score = boost * idf * frequency * (self.k1 + 1) / (frequency + norm)
+                    if score > term_scores[product_id]:
+                        term_scores[product_id] = score
+            # Every term must match something, as with FTS5's implicit AND
+            if scores is None:
+                scores = dict(term_scores)
+            else:
+                scores = {pid: s + term_scores[pid] for pid, s in scores.items() if pid in term_scores}
+            if not scores:
+                break
+        return scores
+
+    def search(self, terms, limit):
+        self._refresh()
+        with self.lock:
+            scores = self._score(terms, fuzzy=False) or self._score(terms, fuzzy=True)
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return [product_id for product_id, _ in ranked[:limit]]
+
+    def matches(self, terms):
+        self._refresh()
+        with self.lock:
+            scores = self._score(terms, fuzzy=False) or self._score(terms, fuzzy=True)
+        if not scores:
+            return None
+        # Written to a temporary table on the session's connection, so any
+        # number of matches can be joined without a bind parameter each.
+        # The rows last until the next call on the same connection.
+        connection = db.session.connection()
+        if not connection.info.get('search_match'):
+            connection.execute(text(
+                'CREATE TEMPORARY TABLE IF NOT EXISTS search_match (product_id INTEGER PRIMARY KEY, score FLOAT)'
+            ))
+            connection.info['search_match'] = True
+        db.session.execute(SEARCH_MATCH.delete())
+        # Negated so lower is better, as with bm25() in SQLite
+        db.session.execute(SEARCH_MATCH.insert(),
+                           [{'product_id': pid, 'score': -value} for pid, value in scores.items()])
+        return db.select(SEARCH_MATCH.c.product_id, SEARCH_MATCH.c.score).subquery('matches')
+
+
+class ProductSearch:
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SEARCH_BACKEND', 'auto')
+        app.config.setdefault('SEARCH_MAX_RESULTS', 500)
+        app.extensions['product_search'] = {'backend': None}
+
+    @property
+    def backend(self):
+        state = current_app.extensions['product_search']
+        if state['backend'] is None:
+            with self.lock:
+                if state['backend'] is None:
+                    state['backend'] = self._create_backend(current_app)
+        return state['backend']
+
+    def _create_backend(self, app):
+        choice = app.config['SEARCH_BACKEND']
+        weights = [FIELD_WEIGHTS['title'], FIELD_WEIGHTS['author'], FIELD_WEIGHTS['description']]
+        if choice == 'fts5' or (choice == 'auto' and FTS5Backend.available(db.engine)):
+            backend = FTS5Backend(weights)
+        else:
+            backend = MemoryBackend(weights)
+        return backend
+
+    def setup(self):
+        # Creates the FTS5 table and triggers (indexing the catalog the first
+        # time) or builds the in-memory index. Run outside requests: by
+        # init_db, gunicorn before it forks workers, or `flask setup-search`.
+        self.backend.setup(db.engine)
+
+    def search(self, query, limit=None):
+        terms = tokenize(query)
+        if not terms:
+            return []
+        return self.backend.search(terms, limit or current_app.config['SEARCH_MAX_RESULTS'])
+
+    def matches(self, query):
+        # Every product matching query as a subquery of (product_id, score),
+        # lower scores ranking higher, for callers to join and filter; None
+        # when nothing can match
+        terms = tokenize(query)
+        if not terms:
+            return None
+        return self.backend.matches(terms)
+
+    def index_product(self, product):
+        self.backend.index_product(product)
+
+    def remove_product(self, product_id):
+        self.backend.remove_product(product_id)
+
+    def rebuild(self):
+        self.backend.rebuild()
+
+    # For writers that bypass index_product, such as bulk imports
+    def products_changed(self, product_ids):
+        if not self.backend.maintained_by_triggers:
+            self.backend.products_changed(product_ids)
+
+    def purge_changes(self, before):
+        # Deletes change log entries older than before, except the newest,
+        # which marks how far the log has been purged; returns the number
+        newest = db.session.query(db.func.max(SearchChange.id)).scalar_subquery()
+        deleted = db.session.execute(db.delete(SearchChange)
+                                     .where(SearchChange.created_at < before, SearchChange.id < newest))
+        db.session.commit()
+        return deleted.rowcount
+
+
+product_search = ProductSearch()
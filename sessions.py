@@ -0,0 +1,196 @@
+import hashlib
+import json
+import os
+import secrets
+import tempfile
+from datetime import datetime
+
+from flask import session
+from flask.sessions import SessionInterface, SessionMixin, session_json_serializer
+from werkzeug.datastructures import CallbackDict
+from models import db, ServerSession
+
+# Server-side sessions. The cookie carries only a random session id; the
+# data (login, flashes, navbar counts) lives in the server_session table
+# (SESSION_BACKEND='sql') or in one file per session under
+# SESSION_FILE_DIR ('filesystem'). 'cookie' keeps Flask's signed cookie.
+#
+# Sessions are written only when they change, or when less than half of
+# PERMANENT_SESSION_LIFETIME is left so active sessions don't expire.
+# `flask purge-sessions` deletes expired ones.
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, expires_at=None):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.expires_at = expires_at
+        self.modified = False
+        self.rotate = False
+
+    def regenerate(self):
+        # Issue a new id when saved, dropping the old one
+        self.rotate = True
+        self.modified = True
+
+
+class SQLSessionStore:
+    # Runs on the 'sessions' bind, an engine with its own pool, so saving a
+    # session never commits the request's ORM transaction or waits for a
+    # connection held by another request
+
+    @property
+    def engine(self):
+        return db.engines['sessions']
+
+    def load(self, key):
+        with self.engine.connect() as conn:
+            row = conn.execute(db.select(ServerSession.data, ServerSession.expires_at)
+                               .where(ServerSession.id == key)).first()
+        return tuple(row) if row else None
+
+    def save(self, key, data, expires_at):
+        table = ServerSession.__table__
+        with self.engine.begin() as conn:
+            updated = conn.execute(table.update().where(table.c.id == key)
+                                   .values(data=data, expires_at=expires_at))
+            if not updated.rowcount:
+                conn.execute(table.insert().values(id=key, data=data, expires_at=expires_at))
+
+    def delete(self, key):
+        with self.engine.begin() as conn:
+            conn.execute(ServerSession.__table__.delete().where(ServerSession.id == key))
+
+    def purge(self, now, batch_size=1000):
+        table = ServerSession.__table__
+        purged = 0
+        while True:
+            with self.engine.begin() as conn:
+                ids = [key for key, in conn.execute(db.select(table.c.id)
+                                                    .where(table.c.expires_at <= now).limit(batch_size))]
+                if ids:
+                    conn.execute(table.delete().where(table.c.id.in_(ids)))
+            purged += len(ids)
+            if len(ids) < batch_size:
+                return purged
+
+
+class FileSystemSessionStore:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def load(self, key):
+        try:
+            with open(self._path(key)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return entry['data'], datetime.fromisoformat(entry['expires_at'])
+
+    def save(self, key, data, expires_at):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'data': data, 'expires_at': expires_at.isoformat()}, f)
+            os.replace(tmp, self._path(key))
+        except OSError:
+            self._remove(tmp)
+            raise
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def delete(self, key):
+        self._remove(self._path(key))
+
+    def purge(self, now, batch_size=None):
+        purged = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith('.tmp'):
+                continue
+            found = self.load(entry.name)
+            if found is None or found[1] <= now:
+                self._remove(entry.path)
+                purged += 1
+        return purged
+
+
+class ServerSideSessionInterface(SessionInterface):
+    serializer = session_json_serializer
+
+    def __init__(self, store):
+        self.store = store
+
+    @staticmethod
+    def _key(sid):
+        # Only a hash of the cookie is stored, so a leaked table or
+        # directory can't be replayed as cookies
+        return hashlib.sha256(sid.encode()).hexdigest()
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            found = self.store.load(self._key(sid))
+            if found and found[1] > datetime.utcnow():
+                try:
+                    return ServerSideSession(self.serializer.loads(found[0]), sid, found[1])
+                except ValueError:
+                    pass
+        return ServerSideSession()
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session:
+            if session.sid:
+                self.store.delete(self._key(session.sid))
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        now = datetime.utcnow()
+        lifetime = app.permanent_session_lifetime
+        stale = session.expires_at is None or session.expires_at - now < lifetime / 2
+        if not (session.modified or stale):
+            return
+        if session.sid and session.rotate:
+            self.store.delete(self._key(session.sid))
+            session.sid = None
+        if not session.sid:
+            session.sid = secrets.token_urlsafe(32)
+        self.store.save(self._key(session.sid), self.serializer.dumps(dict(session)), now + lifetime)
+        response.set_cookie(name, session.sid, expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+                            secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
+        response.vary.add('Cookie')
+
+
+def init_app(app):
+    # Before db.init_app, which creates an engine per bind
+    binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+    binds.setdefault('sessions', app.config['SQLALCHEMY_DATABASE_URI'])
+    app.config['SQLALCHEMY_BINDS'] = binds
+    app.config.setdefault('SESSION_BACKEND', 'sql')
+    app.config.setdefault('SESSION_FILE_DIR', os.path.join(app.instance_path, 'sessions'))
+    backend = app.config['SESSION_BACKEND']
+    if backend == 'sql':
+        app.session_interface = ServerSideSessionInterface(SQLSessionStore())
+    elif backend == 'filesystem':
+        app.session_interface = ServerSideSessionInterface(
+            FileSystemSessionStore(app.config['SESSION_FILE_DIR']))
+
+
+def regenerate():
+    # New session id at login, against session fixation; the signed
+    # cookie backend has no id to change
+    if isinstance(session, ServerSideSession):
+        session.regenerate()